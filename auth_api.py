@@ -1,29 +1,81 @@
 import sys
 import os
-import time
 import base64
+import secrets
 import requests
 import tempfile
 import threading
 import webbrowser
-from dotenv import load_dotenv, set_key
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from playlist_cache import PlaylistCache
+from track_model import TrackList
+from request_layer import RequestLayer
+from metrics import metrics
 from pathlib import Path
 import urllib.parse as url_parse
 from datetime import datetime, timedelta
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+API_BASE_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+# one keep-alive session shared by every request made in this module
+_session = None
+
+def get_session():
+    """Return shared HTTP session (pooled connections)"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # make the pool big enough for the concurrent page fetches
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+# rate limited request layer on top of the shared session
+_requester = None
+
+def get_requester():
+    """Return shared request layer (rate limit, retries, adaptive concurrency)"""
+    global _requester
+    if _requester is None:
+        _requester = RequestLayer(get_session())
+    return _requester
+
+# callback port of the redirect URL, taken if free (0 = any free port)
+CALLBACK_PORT = 8000
 
 class CallbackHandler(BaseHTTPRequestHandler):
-    """Handle OAuth callback"""
+    """
+    Handle OAuth callback: the result (code or error) is stored in
+    server.result and server.done is set, so the waiting flow resumes
+    right away.
+    """
     def do_GET(self):
-        # parse the authorization code from the callback url
-        if "code=" in self.path:
-            # extract code from callback url
-            # callback url path example: "GET /callback?code=ABC123&state=xyz HTTP/1.1"
-            code = self.path.split("code=")[1].split("&")[0]
+        # callback url path example: "/callback?code=ABC123&state=xyz"
+        url = url_parse.urlsplit(self.path)
+        query = url_parse.parse_qs(url.query)
+        code = query.get("code", [None])[0]
+        state = query.get("state", [None])[0]
+        error = query.get("error", [None])[0]
+
+        # favicon requests and the like
+        if url.path != "/callback":
+            self.send_response(404)
+            self.end_headers()
+            return
 
-            # store code in server instance 
-            self.server.auth_code = code
+        if state != self.server.state:
+            # not the answer to our request (CSRF or an old browser tab)
+            self.send_response(400)
+            self.send_header("Content-type", "text/html")
+            self.end_headers()
+            self.wfile.write(b"<h1>Error in authorization: state mismatch</h1>")
+            return
 
+        if code:
             # send HTTP response back to browser
             self.send_response(200)
             self.send_header("Content-type", "text/html")
@@ -44,33 +96,68 @@ class CallbackHandler(BaseHTTPRequestHandler):
             </body>
             </html>
             """
-            html_standard_response = b"""
-            <html>
-                <head><title>Success</title><head>
-                <body>
-                    <h1>Successful authorization! You can close this window.</h1>
-                </body>
-            </html>
-            """
             self.wfile.write(html_autoclose_response.encode())
+            self.server.result = {"code": code}
 
-        # error handeling
+        # error handeling (e.g. user denied access)
         else:
             self.send_response(400)
             self.send_header("Content-type", "text/html")
             self.end_headers()
             self.wfile.write(b"<h1>Error in authorization</h1>")
+            self.server.result = {"error": error or "no code in callback"}
+
+        # wake up the waiting flow
+        self.server.done.set()
     
     def log_message(self, format, *args):
         pass # suppress server log 
 
+def start_callback_server(port=CALLBACK_PORT):
+    """
+    Start the OAuth callback server on 127.0.0.1 in a background thread.
+    If the port is taken a free one is used instead.
+    """
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), CallbackHandler)
+    except OSError:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), CallbackHandler)
+    server.result = None
+    server.done = threading.Event()
+    server.state = secrets.token_urlsafe(16)
+
+    # short poll interval so shutdown() returns quickly
+    server_thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    server_thread.daemon = True  # kill thread when server is shutdown
+    server_thread.start()
+    return server
+
 class SpotifyOAuth():
-    def __init__(self, test=False):
-        """Initialize with app credentials"""
+    def __init__(self, test=False, callback_port=None, auth_timeout=300):
+        """
+        Initialize with app credentials. The callback port comes from
+        `callback_port`, SPOTIFY_CALLBACK_PORT or CALLBACK_PORT and the
+        authorization is given up after `auth_timeout` seconds.
+        """
 
-        self.redirect_url = "http://127.0.0.1:8000/callback"
+        if callback_port is None:
+            callback_port = int(os.getenv("SPOTIFY_CALLBACK_PORT", CALLBACK_PORT))
+        self.callback_port = callback_port
+        self.auth_timeout = auth_timeout
+        self.redirect_url = f"http://127.0.0.1:{callback_port}/callback"
+        self.state = None
+        self.token_url = TOKEN_URL
         self.test = test
 
+        # tokens live in memory, the .env file is only written on refresh
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = None
+        # only one refresh may be in flight at a time
+        self.refresh_lock = threading.RLock()
+        self.refresh_thread = None
+        self.stop_refresh = threading.Event()
+
         # set OAuth  based on test 
         if not self.test:
             self.env_file = Path(".env")
@@ -110,13 +197,13 @@ class SpotifyOAuth():
         """Create .env file with credentials"""
 
         # initial env content 
-        set_key(self.env_file, "SPOTIFY_CLIENT_ID", client_id)
-        set_key(self.env_file, "SPOTIFY_CLIENT_SECRET", client_secret)
+        values = {"SPOTIFY_CLIENT_ID": client_id, "SPOTIFY_CLIENT_SECRET": client_secret}
 
         if access_token:
-            set_key(self.env_file, "SPOTIFY_ACCESS_TOKEN", access_token)
+            values["SPOTIFY_ACCESS_TOKEN"] = access_token
         if refresh_token:
-            set_key(self.env_file, "SPOTIFY_REFRESH_TOKEN", refresh_token)
+            values["SPOTIFY_REFRESH_TOKEN"] = refresh_token
+        self.write_env(values)
 
         # load enviorment 
         self.load_credentials()
@@ -151,6 +238,9 @@ class SpotifyOAuth():
             "scope": scope,
             "show_dialog": True 
         }
+        # echoed back to the callback, protects against forged callbacks
+        if self.state:
+            params["state"] = self.state
 
         # oparser encoder converts the parameters into urls encoded format
         return f"{base_url}?{url_parse.urlencode(params)}"
@@ -161,8 +251,7 @@ class SpotifyOAuth():
         Basic Authentification:
             Authentification: Basic base64encode('client_id:client_secret')
         """
-        url = "https://accounts.spotify.com/api/token"
-        
+        url = self.token_url
 
         # create basic auth header (app authentficatrion)
         credentials = f"{self.client_id}:{self.client_secret}"
@@ -182,7 +271,7 @@ class SpotifyOAuth():
         }
 
         # make request 
-        response = requests.post(url, headers=headers, data=data)
+        response = get_requester().post(url, headers=headers, data=data)
 
         if response.status_code == 200:
             return response.json()
@@ -191,23 +280,25 @@ class SpotifyOAuth():
 
     def user_authorization(self, popup=False):
         """Get user authorization for playlist access"""
+        with metrics.stage("authorization"):
+            return self.run_authorization(popup=popup)
+
+    def run_authorization(self, popup=False):
+        """Authorization flow: browser login and local callback server"""
+        # start local server to catch callback, the redirect URL
+        # follows the port it got
+        server = start_callback_server(self.callback_port)
+        self.redirect_url = f"http://127.0.0.1:{server.server_port}/callback"
+        self.state = server.state
 
         # generate authorization URL 
         auth_url = self.build_auth_url()
-
-        # start local server to catch callback 
-        server = HTTPServer(("localhost", 8000), CallbackHandler)
-        server.auth_code = None
-
-        # run server in background 
-        # create seperate thread to run server 
-        server_thread = threading.Thread(target=server.serve_forever)
-        server_thread.daemon = True  # kill thread when server is shutdown 
-        server_thread.start()
         
         # open browser or popup for authorization
         if not popup:
-            webbrowser.open(auth_url)
+            # headless machines: the URL can be opened anywhere
+            if not webbrowser.open(auth_url):
+                print(f"Open this URL to authorize: {auth_url}")
         else:
             # open html file and repplace placeholder
             with open("spotify_auth.html", "r") as fhand:
@@ -222,17 +313,21 @@ class SpotifyOAuth():
             # open temporary file
             webbrowser.open(f"file://{temp_file}")
 
-        # wait to receive authorizatoin code
-        while server.auth_code is None:
-            time.sleep(1)
-
-        # extract code and  shutdown server
-        auth_code = server.auth_code
-        server.shutdown()
-
-        # clean-up temporary file if popup was used
-        if popup:
-            os.unlink(temp_file)
+        # wait for the callback (no polling), then shutdown server
+        try:
+            received = server.done.wait(self.auth_timeout)
+        finally:
+            server.shutdown()
+            server.server_close()
+            # clean-up temporary file if popup was used
+            if popup:
+                os.unlink(temp_file)
+
+        if not received:
+            raise TimeoutError(f"No authorization within {self.auth_timeout} seconds")
+        if "error" in server.result:
+            raise Exception(f"Authorization failed: {server.result['error']}")
+        auth_code = server.result["code"]
 
         # exchange code for tokens and save tokens to .env
         tokens = self.code_for_token(auth_code)
@@ -241,22 +336,43 @@ class SpotifyOAuth():
 
         return tokens
     
+    def write_env(self, values):
+        """
+        Update keys of the .env file in a single atomic write
+        (temporary file in the same folder, then rename).
+        """
+        lines = self.env_file.read_text().splitlines() if self.env_file.exists() else []
+        remaining = dict(values)
+
+        # update keys that already exist in the file
+        for i, line in enumerate(lines):
+            key = line.split("=", 1)[0].strip()
+            if key in remaining:
+                lines[i] = f"{key}='{remaining.pop(key)}'"
+        # add new keys at the end
+        lines.extend(f"{key}='{value}'" for key, value in remaining.items())
+
+        fd, temp_file = tempfile.mkstemp(dir=self.env_file.resolve().parent, suffix=".env.tmp")
+        with os.fdopen(fd, "w") as fhand:
+            fhand.write("\n".join(lines) + "\n")
+        os.replace(temp_file, self.env_file)
+
     def save_tokens_to_env(self, tokens):
         """Save new tokens into .env file for future usage"""
         expires_at = datetime.now().timestamp() + tokens["expires_in"]
+        values = {"SPOTIFY_ACCESS_TOKEN": tokens["access_token"], "EXPIRATION_DATE": str(expires_at)}
 
-        # update enviroment variables
-        set_key(self.env_file, "SPOTIFY_ACCESS_TOKEN", tokens["access_token"])
-        set_key(self.env_file, "EXPIRATION_DATE", str(expires_at))
+        # update refresh token if needed (often not required)
+        if "refresh_token" in tokens:
+            values["SPOTIFY_REFRESH_TOKEN"] = tokens["refresh_token"]
+            self.refresh_token = tokens["refresh_token"]
 
-        # update instance variables
+        # update instance variables first so readers see the new token
         self.access_token = tokens["access_token"]
         self.expires_at = expires_at
 
-        # update refresh token if needed (often not required)
-        if "refresh_token" in tokens:
-            set_key(self.env_file, "SPOTIFY_REFRESH_TOKEN", tokens["refresh_token"])
-            self.refresh_token = tokens["refresh_token"]
+        # one write of the token store per refresh
+        self.write_env(values)
 
     
     # def save_tokens_to_env(self, tokens):
@@ -313,20 +429,85 @@ class SpotifyOAuth():
         Get access token if it has not yet expired or get a new one
         via the refresh token.
         """
-        # if we have accesstoken and it is not expired use it 
-        if self.access_token and self.expires_at and datetime.now().timestamp() < float(self.expires_at):
+        # if we have accesstoken and it is not expired use it (no lock)
+        if self.token_valid():
             return self.access_token
-        # if expired and we have refresh token, refresh access token
-        elif self.refresh_token:
-            return self.refresh_access_token()
-        # else authentificate 
-        else: 
-            return self.user_authorization()
-
-    def refresh_access_token(self):
-        """Refresh accesstoken using refresh token"""
+
+        # single-flight: other threads wait for the refresh in progress
+        with self.refresh_lock:
+            if self.token_valid():
+                return self.access_token
+            # if expired and we have refresh token, refresh access token
+            elif self.refresh_token:
+                return self.refresh_access_token()
+            # else authentificate 
+            else: 
+                self.user_authorization()
+                return self.access_token
+
+    def token_valid(self, margin=0):
+        """Check if in-memory access token is valid for at least margin seconds"""
+        return bool(self.access_token and self.expires_at
+                    and datetime.now().timestamp() + margin < float(self.expires_at))
+
+    def start_auto_refresh(self, margin=300):
+        """
+        Refresh the access token in a background thread `margin` seconds
+        before it expires, so API calls never wait for a refresh.
+        """
+        if self.refresh_thread and self.refresh_thread.is_alive():
+            return
+        self.stop_refresh.clear()
+        self.refresh_thread = threading.Thread(target=self.auto_refresh, args=(margin,))
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop_auto_refresh(self):
+        """Stop background refresh thread"""
+        self.stop_refresh.set()
+        if self.refresh_thread:
+            self.refresh_thread.join()
+
+    def auto_refresh(self, margin, retry=30, max_retry=600):
+        """
+        Background loop: sleep until shortly before expiry then refresh.
+        It never starts an interactive authorization: without a refresh
+        token or after a failed refresh it logs and backs off (`retry`
+        seconds, doubling up to `max_retry`), the next API call on the
+        main thread authorizes if needed.
+        """
+        backoff = retry
+        while not self.stop_refresh.is_set():
+            wait = float(self.expires_at or 0) - margin - datetime.now().timestamp()
+            if wait > 0:
+                self.stop_refresh.wait(wait)
+                continue
+
+            with self.refresh_lock:
+                # another thread may have refreshed in the meantime
+                if self.token_valid(margin):
+                    continue
+                if not self.refresh_token:
+                    error = "no refresh token"
+                else:
+                    try:
+                        self.refresh_access_token(interactive=False)
+                        backoff = retry
+                        continue
+                    except Exception as e:
+                        error = e
+            print(f"Background token refresh failed: {error}, retrying in {backoff}s")
+            self.stop_refresh.wait(backoff)
+            backoff = min(backoff * 2, max_retry)
+
+    def refresh_access_token(self, interactive=True):
+        """
+        Refresh accesstoken using refresh token. If that fails a new
+        authorization flow is started, or an exception raised when not
+        `interactive`.
+        """
         # refresh access token 
-        url = "https://accounts.spotify.com/api/token"
+        url = self.token_url
 
         credentials = f"{self.client_id}:{self.client_secret}"
         credentials_b64 = base64.b64encode(credentials.encode()).decode()
@@ -341,15 +522,19 @@ class SpotifyOAuth():
             "refresh_token": self.refresh_token
         }
 
-        response = requests.post(url, headers=headers, data=data)
+        with self.refresh_lock, metrics.stage("token_refresh"):
+            response = get_requester().post(url, headers=headers, data=data)
 
-        if response.status_code == 200:
-            tokens = response.json()
-            self.save_tokens_to_env(tokens)
-            return self.access_token
-        else:
-            print("Token refresh failed. Starting new authorization flow...")
-            return self.user_authorization()
+            if response.status_code == 200:
+                tokens = response.json()
+                self.save_tokens_to_env(tokens)
+                return self.access_token
+            elif not interactive:
+                raise Exception(f"Token refresh failed ({response.status_code}): {response.text}")
+            else:
+                print("Token refresh failed. Starting new authorization flow...")
+                self.user_authorization()
+                return self.access_token
 
 
     def authenticate(self):
@@ -368,10 +553,10 @@ class SpotifyOAuth():
             "Content-Type": "application/x-www-form-urlencoded"
         }
         # api requirements 
-        url = "https://accounts.spotify.com/api/token"
+        url = self.token_url
         data = {"grant_type": "client_credentials"}
 
-        respose = requests.post(url, headers=header, data=data)
+        respose = get_requester().post(url, headers=header, data=data)
         return respose.json()
 
 
@@ -384,10 +569,164 @@ class SpotifyOAuth():
     #         return self.authorize()
 
 
+class APIError(Exception):
+    def __init__(self, message, status_code, retry_after=None):
+        """Failed Web API request, with its status and Retry-After header"""
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
 class SpotifyAPI:
-    def __init__(self):
-        pass
-        # self.auth = SpotifyOAuth()
+    def __init__(self, auth=None, max_workers=8, page_size=100, base_url=API_BASE_URL, cache=None):
+        """
+        Spotify Web API client. The OAuth object is created lazily so
+        the API can be built without credentials (e.g. when testing).
+        """
+        self.auth = auth
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.base_url = base_url.rstrip("/")
+        self.requester = get_requester()
+        self.cache = cache
+        # playlist id -> fetched version not yet written to the cache
+        self.uncommitted = {}
+
+    def get_headers(self):
+        """Build authorization header with a valid access token"""
+        if self.auth is None:
+            self.auth = SpotifyOAuth()
+        return {"Authorization": f"Bearer {self.auth.get_access_token()}"}
+
+    def get_response(self, url, params=None, headers=None):
+        """GET request over the shared session, 200 and 304 are accepted"""
+        response = self.requester.get(url, headers={**self.get_headers(), **(headers or {})}, params=params)
+
+        if response.status_code in (200, 304):
+            return response
+        else:
+            raise APIError(f"Request to {url} failed ({response.status_code}): {response.text}",
+                           response.status_code, response.headers.get("Retry-After"))
+
+    def get_json(self, url, params=None):
+        """GET request returning the decoded JSON body"""
+        return self.get_response(url, params=params).json()
 
-    def get_playlist(self):
-        pass
\ No newline at end of file
+    def get_several(self, kind, ids):
+        """
+        Several tracks, albums or artists with one request to Spotify's
+        multi-ID endpoints (see batch_loader for the batch sizes).
+        Objects come back in the order of ids, None for unknown IDs.
+        """
+        return self.get_json(f"{self.base_url}/{kind}", params={"ids": ",".join(ids)})[kind]
+
+    def get_playlist_page(self, playlist_id, offset=0, limit=None):
+        """Get one page of playlist tracks"""
+        url = f"{self.base_url}/playlists/{playlist_id}/tracks"
+        params = {"offset": offset, "limit": limit or self.page_size}
+        return self.get_json(url, params=params)
+
+    def get_playlist(self, playlist_id, max_workers=None):
+        """
+        Generator over all tracks of a playlist. The first page tells us
+        the total, the remaining pages are fetched concurrently and the
+        tracks are yielded in playlist order as soon as they arrive.
+        """
+        limit = self.page_size
+        max_workers = max_workers or self.max_workers
+
+        # first page gives us the total amount of tracks
+        first_page = self.get_playlist_page(playlist_id, offset=0, limit=limit)
+        yield from first_page["items"]
+        # the server may cap the page size below what we asked for
+        limit = first_page.get("limit") or limit
+
+        offsets = list(range(limit, first_page["total"], limit))
+        if not offsets:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # keep at most max_workers pages in flight so memory stays bounded
+            pending = []
+            offsets = iter(offsets)
+            for offset in offsets:
+                pending.append(executor.submit(self.get_playlist_page, playlist_id, offset, limit))
+                if len(pending) >= max_workers:
+                    break
+
+            while pending:
+                page = pending.pop(0).result()
+                # refill window before handing tracks to the caller
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(executor.submit(self.get_playlist_page, playlist_id, next_offset, limit))
+                yield from page["items"]
+
+    def get_playlist_meta(self, playlist_id, fields="snapshot_id", etag=None):
+        """
+        Cheap metadata request for some playlist fields. Returns (fields,
+        etag), fields is None if the server answered 304 Not Modified to
+        our ETag.
+        """
+        url = f"{self.base_url}/playlists/{playlist_id}"
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.get_response(url, params={"fields": fields}, headers=headers)
+
+        if response.status_code == 304:
+            return None, etag
+        return response.json(), response.headers.get("ETag")
+
+    def get_playlist_snapshot(self, playlist_id, etag=None):
+        """
+        Playlist snapshot_id, returns (snapshot_id, etag), snapshot_id is
+        None if the playlist did not change since the ETag.
+        """
+        meta, etag = self.get_playlist_meta(playlist_id, etag=etag)
+        return meta and meta["snapshot_id"], etag
+
+    def get_playlist_tracks(self, playlist_id, commit=True, on_item=None):
+        """
+        Playlist tracks served from the cache when the playlist did not
+        change. Returns (tracks, changed), tracks is a compact TrackList.
+        Without `commit` a changed version is only written to the cache
+        by commit_playlist_tracks (e.g. once it is synced), until then it
+        keeps counting as changed. `on_item(item)` sees every playlist
+        item of a changed playlist as its page arrives.
+        """
+        if self.cache is None:
+            self.cache = PlaylistCache()
+
+        # tracks are only built from the snapshot if it is still current
+        cached = self.cache.snapshot(playlist_id)
+        snapshot_id, etag = self.get_playlist_snapshot(playlist_id, etag=cached.meta["etag"] if cached is not None else None)
+
+        # unchanged: 304 or same snapshot
+        if cached is not None and (snapshot_id is None or snapshot_id == cached.meta["snapshot_id"]):
+            self.cache.hits += 1
+            metrics.inc("playlist_cache_hits_total")
+            return TrackList.from_snapshot(cached), False
+
+        self.cache.misses += 1
+        metrics.inc("playlist_cache_misses_total")
+        # pages are dropped as soon as their tracks are in the list
+        def items():
+            for item in self.get_playlist(playlist_id):
+                if on_item is not None:
+                    on_item(item)
+                yield item
+
+        tracks = TrackList.from_items(items())
+        self.uncommitted[playlist_id] = (snapshot_id, etag, tracks)
+        if commit:
+            self.commit_playlist_tracks(playlist_id)
+        return tracks, True
+
+    def commit_playlist_tracks(self, playlist_id):
+        """Write the version last returned by get_playlist_tracks to the cache"""
+        version = self.uncommitted.pop(playlist_id, None)
+        if version is None:
+            return
+        self.cache.put(playlist_id, *version)
+        added, removed = self.cache.changes(playlist_id)
+        metrics.inc("playlist_tracks_added_total", len(added))
+        metrics.inc("playlist_tracks_removed_total", len(removed))
@@ -0,0 +1,191 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from metrics import metrics
+
+# max IDs per request of Spotify's multi-ID endpoints
+BATCH_SIZES = {"tracks": 50, "albums": 20, "artists": 50}
+
+class BatchLoader:
+    def __init__(self, fetch, kind, batch_size=None, max_delay=0.1, max_workers=8):
+        """
+        Collect IDs asked for by any thread and fetch them with one
+        multi-ID request as soon as `batch_size` are waiting or after
+        `max_delay` seconds. `fetch(kind, ids)` returns the objects in
+        the order of ids (None for unknown IDs). Results are cached for
+        the lifetime of the process and an ID asked for while its request
+        is in flight shares that request. Batches are sent from a pool of
+        `max_workers` threads, so callers never wait for a request they
+        don't need the result of.
+        """
+        self.fetch = fetch
+        self.kind = kind
+        self.batch_size = batch_size or BATCH_SIZES[kind]
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.cache = {}
+        # ID -> Future of waiting and in-flight IDs
+        self.futures = {}
+        self.queue = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def load(self, item_id):
+        """Future of the object with this ID, does not block"""
+        with self.lock:
+            if item_id in self.cache:
+                metrics.inc(f"{self.kind}_cache_hits_total")
+                future = Future()
+                future.set_result(self.cache[item_id])
+                return future
+
+            future = self.futures.get(item_id)
+            if future is None:
+                metrics.inc(f"{self.kind}_cache_misses_total")
+                future = self.futures[item_id] = Future()
+                self.queue.append(item_id)
+
+            batch = self.take_locked() if len(self.queue) >= self.batch_size else None
+            if self.queue and self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if batch:
+            self.executor.submit(self.send, batch)
+        return future
+
+    def load_many(self, ids):
+        """{ID: object} for many IDs, waiting ones are sent right away"""
+        futures = {item_id: self.load(item_id) for item_id in ids}
+        self.flush()
+        return {item_id: future.result() for item_id, future in futures.items()}
+
+    def take_locked(self):
+        batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+        return batch
+
+    def flush(self):
+        """Send every waiting ID now (also called by the timer)"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batches = []
+            while self.queue:
+                batches.append(self.take_locked())
+
+        for batch in batches:
+            self.executor.submit(self.send, batch)
+
+    def send(self, batch):
+        """One multi-ID request, resolves the futures of the batch"""
+        with self.lock:
+            self.requests += 1
+        try:
+            results = self.fetch(self.kind, batch)
+        except Exception as e:
+            # failures are not cached, the next load asks again
+            with self.lock:
+                futures = [self.futures.pop(item_id) for item_id in batch]
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        with self.lock:
+            futures = []
+            for item_id, result in zip(batch, results):
+                self.cache[item_id] = result
+                futures.append(self.futures.pop(item_id))
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+class Enricher:
+    def __init__(self, api, max_delay=0.1, max_workers=8):
+        """
+        Track enrichment (ISRC, album art, release date, artist genres)
+        through batched lookups: one request per 50 tracks, 20 albums or
+        50 artists instead of one per track.
+        """
+        self.loaders = {kind: BatchLoader(api.get_several, kind, max_delay=max_delay,
+                                          max_workers=max_workers)
+                        for kind in BATCH_SIZES}
+
+    @property
+    def requests(self):
+        return sum(loader.requests for loader in self.loaders.values())
+
+    def flush(self):
+        """Send all queued lookups now"""
+        for loader in self.loaders.values():
+            loader.flush()
+
+    def prefetch(self, track):
+        """
+        Queue the lookups of a track without waiting, so IDs of all
+        tracks in flight end up in the same requests. Returns the futures
+        enrich_track waits for.
+        """
+        track = track.get("track", track)
+        futures = {}
+        if track.get("id") and not ((track.get("external_ids") or {}).get("isrc")
+                                    and (track.get("album") or {}).get("id")):
+            futures["track"] = self.loaders["tracks"].load(track["id"])
+        album_id = (track.get("album") or {}).get("id")
+        if album_id:
+            futures["album"] = self.loaders["albums"].load(album_id)
+        futures["artists"] = [self.loaders["artists"].load(artist["id"])
+                              for artist in track.get("artists") or [] if artist.get("id")]
+        return futures
+
+    def merge_track(self, track, futures):
+        """Fill ISRC and album from the full track (if it was looked up)"""
+        future = futures.pop("track", None)
+        full = future.result() if future else None
+        if not full:
+            return
+        track.setdefault("external_ids", {}).update(full.get("external_ids") or {})
+        album = dict(full.get("album") or {})
+        album.update({key: value for key, value in (track.get("album") or {}).items() if value})
+        track["album"] = album
+        # the album ID may only be known now
+        if "album" not in futures and album.get("id"):
+            futures["album"] = self.loaders["albums"].load(album["id"])
+
+    def enrich_track(self, track, futures=None):
+        """Add the looked up fields to a (slim) track, in place"""
+        track = track.get("track", track)
+        futures = futures or self.prefetch(track)
+        self.merge_track(track, futures)
+
+        if "album" in futures:
+            album = futures["album"].result()
+            if album:
+                track["album"]["release_date"] = album.get("release_date")
+                images = album.get("images") or []
+                track["album"]["image"] = images[0]["url"] if images else None
+
+        genres = []
+        for future in futures["artists"]:
+            artist = future.result()
+            if artist:
+                genres += [genre for genre in artist.get("genres") or [] if genre not in genres]
+        track["genres"] = genres
+        return track
+
+    def enrich(self, tracks):
+        """Enrich many tracks, all lookups are queued before waiting"""
+        tracks = [track.get("track", track) for track in tracks]
+        futures = [self.prefetch(track) for track in tracks]
+        self.flush()
+
+        # full track lookups can reveal more albums to look up
+        for track, track_futures in zip(tracks, futures):
+            self.merge_track(track, track_futures)
+        self.loaders["albums"].flush()
+
+        for track, track_futures in zip(tracks, futures):
+            self.enrich_track(track, track_futures)
+        return tracks
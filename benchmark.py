@@ -0,0 +1,463 @@
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+import fake_server
+from auth_api import SpotifyOAuth, SpotifyAPI, get_session
+from request_layer import RequestLayer
+from local_library import LibraryIndex, song_key, normalize_key
+from song_matcher import SongMatcher
+from downloader import DownloadJob, DownloadScheduler
+from batch_loader import Enricher
+
+class StaticToken:
+    """Auth stand-in handing out a fixed token"""
+    def get_access_token(self):
+        return "benchmark"
+
+
+def timed(function, *args, **kwargs):
+    """Run function and return (result, seconds)"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_pagination(server, args):
+    """Stream a whole playlist through SpotifyAPI.get_playlist"""
+    api = SpotifyAPI(auth=StaticToken(), base_url=server.base_url + "/v1", max_workers=args.workers)
+    api.requester = RequestLayer(get_session(), rate=args.rate, burst=args.workers,
+                                 initial_concurrency=args.workers, max_concurrency=args.workers * 4)
+
+    requests_before = server.requests
+    count, seconds = timed(lambda: sum(1 for _ in api.get_playlist("bench")))
+    return {
+        "tracks": count,
+        "seconds": round(seconds, 4),
+        "tracks_per_sec": round(count / seconds, 1),
+        "requests": server.requests - requests_before,
+        "throttled": api.requester.throttled,
+    }
+
+def bench_token_refresh(server, args):
+    """Token refresh round trips and hot-path get_access_token calls"""
+    oauth = SpotifyOAuth(test=True)
+    oauth.token_url = server.base_url + "/api/token"
+    oauth.client_id, oauth.client_secret, oauth.refresh_token = "id", "secret", "refresh"
+    oauth.env_file = Path(tempfile.mkdtemp()) / ".env"
+
+    refreshes = 20
+    _, refresh_seconds = timed(lambda: [oauth.refresh_access_token() for _ in range(refreshes)])
+
+    calls = 100_000
+    _, hot_seconds = timed(lambda: [oauth.get_access_token() for _ in range(calls)])
+    oauth.env_file.unlink()
+    return {
+        "refresh_ms": round(refresh_seconds / refreshes * 1000, 3),
+        "get_access_token_us": round(hot_seconds / calls * 1e6, 3),
+    }
+
+def make_library(folder, size, per_dir=500):
+    """Empty audio files spread over sub folders"""
+    for i in range(size):
+        sub = Path(folder) / f"dir{i // per_dir:04d}"
+        if i % per_dir == 0:
+            sub.mkdir(parents=True, exist_ok=True)
+        (sub / f"Artist {i % 997} - Song {i}.mp3").touch()
+
+def bench_local_scan(args):
+    """Cold scan and unchanged rescan of the library index"""
+    with tempfile.TemporaryDirectory() as folder:
+        make_library(folder, args.library)
+        library = LibraryIndex(folder)
+        dirs, cold = timed(library.scan)
+        rescanned, warm = timed(library.scan)
+        files = len(library)
+        library.close()
+    return {
+        "files": files,
+        "cold_seconds": round(cold, 4),
+        "rescan_seconds": round(warm, 4),
+        "rescanned_dirs": rescanned,
+    }
+
+def bench_diff(args):
+    """Diff a playlist against a library (exact + fuzzy tiers)"""
+    rnd = random.Random(0)
+    word = lambda: "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(3, 9)))
+
+    songs = []
+    for i in range(args.library):
+        title, artist = f"{word()} {word()}", word()
+        songs.append((f"song{i}.mp3", song_key(title, artist), normalize_key(title), None, None, title, artist))
+
+    tracks = []
+    for i in range(args.tracks):
+        _, _, _, _, _, title, artist = songs[rnd.randrange(len(songs))]
+        if i % 10 == 0:
+            title = word() + " " + word()    # missing
+        elif i % 10 == 1:
+            title = title + "s"              # fuzzy
+        tracks.append({"id": f"t{i}", "name": title, "artists": [{"name": artist}]})
+
+    matcher, build = timed(SongMatcher, [row[:5] for row in songs])
+    results, seconds = timed(matcher.diff, tracks)
+    tiers = {}
+    for _, tier, _ in results:
+        tiers[str(tier)] = tiers.get(str(tier), 0) + 1
+    return {"library": len(songs), "tracks": len(tracks), "build_seconds": round(build, 4),
+            "diff_seconds": round(seconds, 4), "tiers": tiers}
+
+def bench_downloads(server, args):
+    """Parallel downloads from the fake server"""
+    with tempfile.TemporaryDirectory() as folder:
+        scheduler = DownloadScheduler(folder, max_workers=args.workers)
+        jobs = [DownloadJob(f"{server.base_url}/files/{i}", f"song{i}.mp3") for i in range(args.downloads)]
+        _, seconds = timed(scheduler.run, jobs)
+        failed = sum(job.status != "done" for job in jobs)
+    total = args.downloads * server.file_size
+    return {"files": args.downloads, "failed": failed, "seconds": round(seconds, 4),
+            "mb_per_sec": round(total / seconds / 1e6, 2)}
+
+def bench_enrich(server, args):
+    """Batched track/album/artist lookups for a whole playlist"""
+    api = SpotifyAPI(auth=StaticToken(), base_url=server.base_url + "/v1", max_workers=args.workers)
+    api.requester = RequestLayer(get_session(), rate=args.rate, burst=args.workers,
+                                 initial_concurrency=args.workers, max_concurrency=args.workers * 4)
+    # slim tracks without ISRC also need the track lookup
+    tracks = [{"id": f"track{i:07d}", "name": f"Song {i}",
+               "artists": [{"id": f"artist{i % 997}", "name": f"Artist {i % 997}"}],
+               "album": {"id": f"album{i % 4999}"} if i % 2 else {}}
+              for i in range(args.tracks)]
+
+    # one request per track, album and artist without batching
+    unbatched = sum(2 + len(track["artists"]) for track in tracks)
+
+    requests_before = server.requests
+    enricher = Enricher(api, max_workers=args.workers)
+    _, seconds = timed(enricher.enrich, tracks)
+    return {
+        "tracks": len(tracks),
+        "seconds": round(seconds, 4),
+        "requests": server.requests - requests_before,
+        "unbatched_requests": unbatched,
+        "enriched": sum(bool(t["album"].get("release_date")) for t in tracks),
+    }
+
+def bench_snapshot(args):
+    """
+    Playlist state as columnar snapshots (PlaylistCache) against JSON:
+    file sizes, load time, a 1% change stored as delta and the ID diff.
+    """
+    from playlist_cache import PlaylistCache, slim_track
+
+    tracks = [slim_track(fake_server.fake_track(i)) for i in range(args.tracks)]
+    changed = max(1, args.tracks // 100)
+    today = tracks[changed:] + [slim_track(fake_server.fake_track(args.tracks + i)) for i in range(changed)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        json_file = Path(folder) / "playlist.json"
+        _, json_write = timed(lambda: json_file.write_text(json.dumps({"tracks": tracks})))
+        _, json_load = timed(lambda: json.loads(json_file.read_text()))
+
+        cache = PlaylistCache(Path(folder) / "snapshots")
+        _, write = timed(cache.put, "bench", "s1", None, tracks)
+        full_size = cache.files("bench")[0].stat().st_size
+        snapshot, load = timed(cache.snapshot, "bench")
+        _, materialize = timed(snapshot.tracks)
+
+        _, delta_write = timed(cache.put, "bench", "s2", None, today)
+        delta_size = cache.files("bench")[-1].stat().st_size
+        _, delta_load = timed(cache.snapshot, "bench")
+        (added, removed), diff = timed(cache.changes, "bench")
+        json_size = json_file.stat().st_size
+
+    return {
+        "tracks": len(tracks),
+        "json_bytes": json_size,
+        "json_load_ms": round(json_load * 1000, 2),
+        "json_write_ms": round(json_write * 1000, 2),
+        "snapshot_bytes": full_size,
+        "snapshot_write_ms": round(write * 1000, 2),
+        "snapshot_load_ms": round(load * 1000, 2),
+        "materialize_ms": round(materialize * 1000, 2),
+        "delta_bytes": delta_size,
+        "delta_write_ms": round(delta_write * 1000, 2),
+        "delta_load_ms": round(delta_load * 1000, 2),
+        "diff_ms": round(diff * 1000, 2),
+        "added": len(added),
+        "removed": len(removed),
+    }
+
+def bench_track_memory(args):
+    """
+    Memory held by a playlist as fake API items, slim track dicts and a
+    TrackList streamed from the items (real API items are several times
+    bigger than the fake ones).
+    """
+    import gc
+    import tracemalloc
+    from playlist_cache import slim_track
+    from track_model import TrackList
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        result, seconds = timed(build)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del result
+        return round(size / args.tracks), round(seconds, 4)
+
+    items = lambda: (fake_server.fake_track(i) for i in range(args.tracks))
+    results = {"tracks": args.tracks}
+    for name, build in (("raw_items", lambda: list(items())),
+                        ("slim_dicts", lambda: [slim_track(item) for item in items()]),
+                        ("track_list", lambda: TrackList.from_items(items()))):
+        results[f"{name}_bytes_per_track"], results[f"{name}_seconds"] = measure(build)
+    return results
+
+def bench_service(server, args):
+    """
+    Load test of the playlist service (spotify_api, needs flask) against
+    the fake upstream: one cold request, then concurrent clients asking
+    for the same playlist, some of them with the ETag they already have.
+    """
+    import threading
+    import concurrent.futures
+    import auth_api
+    import spotify_api
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from playlist_cache import PlaylistCache
+
+    with tempfile.TemporaryDirectory() as folder:
+        spotify_api.API_BASE_URL = server.base_url + "/v1"
+        spotify_api.TOKEN_URL = server.base_url + "/api/token"
+        spotify_api._store = spotify_api.TokenStore(Path(folder) / "service.db")
+        spotify_api._store.put(spotify_api.SERVICE_USER, "benchmark", "refresh", time.time() + 3600)
+        spotify_api._responses = spotify_api.PlaylistResponses(PlaylistCache(Path(folder) / "playlists"))
+        requester = auth_api._requester
+        auth_api._requester = RequestLayer(get_session(), rate=args.rate, burst=args.workers,
+                                           initial_concurrency=args.workers,
+                                           max_concurrency=args.workers * 4)
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass # suppress request log
+
+        http = make_server("127.0.0.1", 0, spotify_api.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=http.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{http.server_port}/playlist/bench"
+        try:
+            client = get_session()
+            first, cold = timed(client.get, url)
+            etag = first.headers["ETag"]
+
+            def fetch(i):
+                headers = {"If-None-Match": etag} if i % 2 else {}
+                start = time.perf_counter()
+                # the body is read as sent (gzip), not decoded
+                with client.get(url, headers=headers, stream=True) as response:
+                    response.raw.read(decode_content=False)
+                return response.status_code, time.perf_counter() - start
+
+            requests_before = server.requests
+            with concurrent.futures.ThreadPoolExecutor(args.workers * 4) as executor:
+                results, seconds = timed(lambda: list(executor.map(fetch, range(args.service_requests))))
+            latencies = sorted(latency for _, latency in results)
+        finally:
+            http.shutdown()
+            auth_api._requester = requester
+            spotify_api._store.conn.close()
+
+    return {
+        "tracks": len(first.json()["tracks"]),
+        "cold_seconds": round(cold, 4),
+        "body_bytes": int(first.headers.get("Content-Length") or len(first.content)),
+        "requests": len(results),
+        "requests_per_sec": round(len(results) / seconds, 1),
+        "not_modified": sum(status == 304 for status, _ in results),
+        "errors": sum(status not in (200, 304) for status, _ in results),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        "upstream_requests": server.requests - requests_before,
+    }
+
+def queue_worker(barrier, *args, **kwargs):
+    """Worker process of bench_work_queue, starts working once all are up"""
+    from music_downloader import sync_worker
+    barrier.wait()
+    sync_worker(*args, **kwargs)
+
+def bench_work_queue(args):
+    """
+    One sync plan worked by 1, 2, 4... worker processes through the shared
+    queue, against a source that takes --file-latency per file. Process
+    start-up is timed separately.
+    """
+    import multiprocessing
+    from functools import partial
+    from music_downloader import MusicDownloader
+    from work_queue import WorkQueue, DONE
+
+    server = fake_server.start_fake_spotify(file_size=args.file_size, file_latency=args.file_latency)
+    tracks = [fake_server.fake_track(i) for i in range(args.downloads)]
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for count in args.queue_workers:
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            mdownload = MusicDownloader(test=True)
+            mdownload.target_folder = folder / "music"
+            mdownload.target_folder.mkdir()
+            queue = WorkQueue(folder / "queue.db")
+            mdownload.plan_sync(tracks, queue, "bench")
+
+            barrier = context.Barrier(count + 1)
+            options = {"source_cache": folder / "sources.db", "max_workers": 2, "poll": 0.1}
+            workers = [context.Process(target=queue_worker, kwargs=options, args=(
+                           barrier, folder / "queue.db", mdownload.target_folder,
+                           partial(fake_server.fake_file_url, server.base_url)))
+                       for _ in range(count)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            barrier.wait()
+            startup = time.perf_counter() - start
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start - startup
+            done = queue.counts()[DONE]
+            queue.close()
+        results[str(count)] = {"done": done, "startup_seconds": round(startup, 3),
+                               "seconds": round(seconds, 3), "songs_per_sec": round(done / seconds, 1)}
+    server.shutdown()
+
+    base = results[str(args.queue_workers[0])]["songs_per_sec"] / args.queue_workers[0]
+    for count in args.queue_workers:
+        result = results[str(count)]
+        result["efficiency"] = round(result["songs_per_sec"] / (base * count), 2)
+    return results
+
+# modules trivial commands must not load
+HEAVY_MODULES = ["requests", "dotenv", "http.server", "webbrowser", "sqlite3", "auth_api"]
+
+def bench_startup(args):
+    """
+    Cold start of trivial commands: `-X importtime` of the CLI module,
+    wall time of `--help`, and the heavy modules that got imported.
+    """
+    script = Path(__file__).parent / "music_downloader.py"
+    cwd = Path(__file__).parent
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import music_downloader"],
+                            capture_output=True, text=True, cwd=cwd)
+    import_us = None
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "music_downloader":
+            import_us = int(fields[1])
+
+    check = ("import sys, music_downloader; "
+             f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    loaded = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True,
+                            cwd=cwd).stdout.strip()
+
+    runs = 5
+    _, help_seconds = timed(lambda: [subprocess.run([sys.executable, str(script), "--help"],
+                                                    capture_output=True) for _ in range(runs)])
+    import_ms = round(import_us / 1000, 3) if import_us is not None else None
+    return {
+        "import_ms": import_ms,
+        "help_ms": round(help_seconds / runs * 1000, 1),
+        "heavy_modules": loaded.split(",") if loaded else [],
+        "budget_ms": args.startup_budget_ms,
+        "within_budget": bool(import_ms is not None and import_ms <= args.startup_budget_ms and not loaded),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+BENCHMARKS = ["pagination", "token_refresh", "local_scan", "diff", "downloads", "enrich", "snapshot",
+              "track_memory", "service", "work_queue", "startup"]
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Offline benchmarks against a local fake Spotify server")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Benchmarks to run (default all).")
+    parser.add_argument("--tracks", type=int, default=10_000, help="Playlist size (up to 100k).")
+    parser.add_argument("--library", type=int, default=20_000, help="Local library size.")
+    parser.add_argument("--downloads", type=int, default=100, help="Number of files to download.")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="Size of downloaded files.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake server latency in seconds.")
+    parser.add_argument("--page-size", type=int, default=100, help="Max page size of the fake server.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered 429.")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Client token bucket rate (req/s).")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrency for pages and downloads.")
+    parser.add_argument("--service-requests", type=int, default=2000,
+                        help="Requests sent to the playlist service.")
+    parser.add_argument("--queue-workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker process counts for the work queue benchmark.")
+    parser.add_argument("--file-latency", type=float, default=0.1,
+                        help="Per file latency of the source in the work queue benchmark.")
+    parser.add_argument("--startup-budget-ms", type=float, default=50.0,
+                        help="Max import time of the CLI module for trivial commands.")
+    parser.add_argument("--output", help="Write JSON results to this file.")
+    args = parser.parse_args()
+
+    server = fake_server.start_fake_spotify(
+        playlists={"bench": args.tracks}, latency=args.latency, page_size=args.page_size,
+        rate_429=args.rate_429, file_size=args.file_size)
+
+    benchmarks = {
+        "pagination": lambda: bench_pagination(server, args),
+        "token_refresh": lambda: bench_token_refresh(server, args),
+        "local_scan": lambda: bench_local_scan(args),
+        "diff": lambda: bench_diff(args),
+        "downloads": lambda: bench_downloads(server, args),
+        "enrich": lambda: bench_enrich(server, args),
+        "snapshot": lambda: bench_snapshot(args),
+        "track_memory": lambda: bench_track_memory(args),
+        "service": lambda: bench_service(server, args),
+        "work_queue": lambda: bench_work_queue(args),
+        "startup": lambda: bench_startup(args),
+    }
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = benchmarks[name]()
+    server.shutdown()
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+    # startup regression fails the run
+    if "startup" in results and not results["startup"]["within_budget"]:
+        sys.exit("Startup is over budget or loads heavy modules")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import os
+import sys
+import ctypes
+import hashlib
+import threading
+import urllib.parse as url_parse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from auth_api import get_session
+from metrics import metrics
+
+# bytes read per body chunk, also the size of the buffer each worker
+# reuses to hash resumed .part files
+CHUNK_SIZE = 256 * 1024
+
+# fallocate() flag: reserve blocks but leave the file size alone
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+_syncfs = None
+
+def preallocate(fd, offset, length):
+    """
+    Reserve disk space for the rest of a download (Linux only). The file
+    size is not changed, so a crashed download never leaves a .part file
+    that looks complete.
+    """
+    global _fallocate
+    if length <= 0 or not sys.platform.startswith("linux"):
+        return
+    try:
+        if _fallocate is None:
+            _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length)
+    except (OSError, AttributeError):
+        pass
+
+def flush_filesystem(fd):
+    """
+    Write back every dirty file of the filesystem holding `fd` with one
+    syncfs() call (Linux only). Returns False if that is not available.
+    """
+    global _syncfs
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        if _syncfs is None:
+            _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+            _syncfs.argtypes = [ctypes.c_int]
+        return _syncfs(fd) == 0
+    except (OSError, AttributeError):
+        return False
+
+class FsyncBatch:
+    def __init__(self):
+        """
+        Group commit of finished downloads: flush the .part files with one
+        syncfs per filesystem (an fsync per file where there is none),
+        rename them into place and fsync their folder once. Files
+        finishing while a batch is being synced wait and go into the next
+        batch together, so parallel downloads share one flush.
+        """
+        self.pending = []
+        self.syncing = False
+        self.condition = threading.Condition()
+        self.batches = 0
+
+    def commit(self, part, target):
+        """Durably move part to target (blocks until its batch is synced)"""
+        item = {"part": part, "target": target, "done": False, "error": None}
+        with self.condition:
+            self.pending.append(item)
+            while not item["done"] and self.syncing:
+                self.condition.wait()
+            if item["done"]:
+                batch = None
+            else:
+                # become the leader of everything waiting
+                self.syncing = True
+                batch, self.pending = self.pending, []
+
+        if batch is not None:
+            try:
+                self.sync(batch)
+            finally:
+                with self.condition:
+                    for batch_item in batch:
+                        batch_item["done"] = True
+                    self.syncing = False
+                    self.batches += 1
+                    self.condition.notify_all()
+
+        if item["error"]:
+            raise item["error"]
+
+    def sync(self, batch):
+        folders, flushed = set(), set()
+        for item in batch:
+            try:
+                fd = os.open(item["part"], os.O_RDONLY)
+                try:
+                    # the first part of a filesystem flushes all of them
+                    device = os.fstat(fd).st_dev
+                    if device not in flushed:
+                        if flush_filesystem(fd):
+                            flushed.add(device)
+                        else:
+                            os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(item["part"], item["target"])
+                folders.add(os.path.dirname(os.path.abspath(item["target"])))
+            except OSError as e:
+                item["error"] = e
+
+        # make the renames durable (not possible on Windows)
+        for folder in folders:
+            try:
+                fd = os.open(folder, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+
+class DownloadJob:
+    def __init__(self, url, filename, track_id=None, checksum=None):
+        """
+        Single file to download into the target folder. `checksum` is
+        the expected sha256 (hex) if known. After the download `sha256`
+        and `size` describe the file.
+        """
+        self.url = url
+        self.filename = filename
+        self.track_id = track_id
+        self.checksum = checksum
+        self.status = "pending"
+        self.error = None
+        self.path = None
+        self.sha256 = None
+        self.size = None
+
+    def __repr__(self):
+        return f"DownloadJob({self.filename!r}, status={self.status!r})"
+
+
+class DownloadScheduler:
+    def __init__(self, target_folder, max_workers=8, per_host=4, timeout=30):
+        """
+        Download files with a bounded worker pool and a concurrency limit
+        per host. Data goes to "<name>.part" first and is renamed into the
+        target folder once complete, so an interrupted run resumes the
+        partial file with an HTTP Range request.
+
+        Bodies are streamed in CHUNK_SIZE chunks and hashed and counted
+        in the same pass as the write, so memory stays constant and every
+        byte is touched once.
+        """
+        self.target_folder = Path(target_folder)
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.session = get_session()
+
+        self.host_limits = {}
+        self.file_locks = {}
+        self.lock = threading.Lock()
+        self.buffers = threading.local()
+        self.fsync_batch = FsyncBatch()
+
+    def host_limit(self, url):
+        """Semaphore limiting the parallel downloads of one host"""
+        host = url_parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def file_lock(self, filename):
+        """Lock so the same file is never downloaded twice at once"""
+        with self.lock:
+            return self.file_locks.setdefault(filename, threading.Lock())
+
+    def buffer(self):
+        """Read buffer of the calling worker thread"""
+        view = getattr(self.buffers, "view", None)
+        if view is None:
+            view = self.buffers.view = memoryview(bytearray(CHUNK_SIZE))
+        return view
+
+    def hash_part(self, part, digest):
+        """Feed an existing .part file to the hash (resumed downloads)"""
+        view = self.buffer()
+        with open(part, "rb", buffering=0) as fhand:
+            while size := fhand.readinto(view):
+                digest.update(view[:size])
+
+    def write_body(self, response, part, offset, digest):
+        """
+        Stream the response body into the .part file from `offset` on,
+        hashing in the same pass. A Content-Encoding (gzip, ...) is
+        decoded, file and hash hold the real content. Reading through
+        urllib3 to the end hands the connection back to the pool.
+        Returns the number of bytes written.
+        """
+        raw = response.raw
+        length = response.headers.get("Content-Length")
+        length = int(length) if length and length.isdigit() else None
+        encoded = bool(response.headers.get("Content-Encoding"))
+        written = 0
+
+        # unbuffered: chunks go straight to the kernel
+        with open(part, "ab" if offset else "wb", buffering=0) as fhand:
+            if length and not encoded:
+                preallocate(fhand.fileno(), offset, length)
+            while chunk := raw.read(CHUNK_SIZE, decode_content=True):
+                fhand.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+
+        metrics.inc("download_bytes_total", written)
+        # Content-Length counts the (encoded) bytes on the wire
+        if length is not None and raw.tell() != length:
+            # keep the .part file, the next run resumes it
+            raise Exception(f"Download of {response.url} truncated ({raw.tell()} of {length} bytes)")
+        return written
+
+    def download(self, job):
+        """Download one job, resuming its .part file if there is one"""
+        target = self.target_folder / job.filename
+        part = self.target_folder / f"{job.filename}.part"
+
+        with self.file_lock(job.filename):
+            if target.exists():
+                job.status, job.path = "skipped", target
+                return job
+
+            digest = hashlib.sha256()
+            with self.host_limit(job.url):
+                offset = part.stat().st_size if part.exists() else 0
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+                with self.session.get(job.url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    # range not satisfiable: the .part file is already complete
+                    if response.status_code == 416 and offset:
+                        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                        if total.isdigit() and int(total) != offset:
+                            part.unlink()
+                            raise Exception(f"Partial download of {job.url} is corrupt, removed")
+                        self.hash_part(part, digest)
+                        job.size = offset
+                    elif response.status_code in (200, 206):
+                        # server ignored the range, start from scratch
+                        if response.status_code == 200:
+                            offset = 0
+                        elif offset:
+                            self.hash_part(part, digest)
+                        job.size = offset + self.write_body(response, part, offset, digest)
+                    else:
+                        raise Exception(f"Download of {job.url} failed ({response.status_code})")
+
+            job.sha256 = digest.hexdigest()
+            if job.checksum and job.checksum != job.sha256:
+                part.unlink()
+                raise Exception(f"Checksum mismatch for {job.url}")
+
+            # fsync (batched with other finished downloads) and atomic move
+            self.fsync_batch.commit(part, target)
+            job.status, job.path = "done", target
+            metrics.inc("downloads_total")
+            return job
+
+    def run(self, jobs, on_complete=None):
+        """
+        Download all jobs, returns them with their status set.
+        `on_complete(job)` is called as each job finishes or fails.
+        """
+        self.target_folder.mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.download, job): job for job in jobs}
+            try:
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        job.status, job.error = "failed", str(e)
+                    if on_complete:
+                        on_complete(job)
+            except KeyboardInterrupt:
+                # keep the .part files, the next run resumes them
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return jobs
@@ -0,0 +1,213 @@
+import re
+import json
+import time
+import random
+import threading
+import urllib.parse as url_parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve in-memory files with HTTP Range support (used for testing)"""
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass # suppress server log
+
+
+def start_server(handler, port=0, **attributes):
+    """
+    Run a threaded HTTP server in the background on localhost.
+    Extra keyword arguments are stored on the server instance.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    server.base_url = f"http://127.0.0.1:{server.server_port}"
+    return server
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for accounts.spotify.com/api/token and the /v1/playlists
+    endpoints. Behaviour is set on the server (see start_fake_spotify):
+    latency, max page size, 429 injection rate and playlist sizes.
+    """
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def throttle(self):
+        """Simulate latency and inject 429s, returns True if throttled"""
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        if server.rate_429 and server.random.random() < server.rate_429:
+            with server.lock:
+                server.throttled += 1
+            self.send_json({"error": {"status": 429}}, status=429, headers={"Retry-After": "0"})
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.throttle():
+            return
+        with self.server.lock:
+            self.server.tokens_issued += 1
+            token = f"token{self.server.tokens_issued}"
+        self.send_json({"access_token": token, "token_type": "Bearer",
+                        "expires_in": self.server.expires_in, "refresh_token": "refresh"})
+
+    def do_GET(self):
+        url = url_parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        query = dict(url_parse.parse_qsl(url.query))
+
+        # /files/<track id>: audio file for download benchmarks
+        if parts[0] == "files":
+            # a slow remote source, per file
+            time.sleep(self.server.file_latency)
+            self.send_response(200)
+            self.send_header("Content-Length", str(self.server.file_size))
+            self.end_headers()
+            self.wfile.write(self.server.file_data)
+            return
+
+        # /v1/tracks|albums|artists?ids=...: multi-ID lookups
+        if len(parts) == 2 and parts[0] == "v1" and parts[1] in FAKE_OBJECTS:
+            if self.throttle():
+                return
+            ids = query.get("ids", "").split(",")
+            self.send_json({parts[1]: [FAKE_OBJECTS[parts[1]](item_id) for item_id in ids]})
+            return
+
+        if len(parts) < 3 or parts[:2] != ["v1", "playlists"] or parts[2] not in self.server.playlists:
+            self.send_json({"error": {"status": 404}}, status=404)
+            return
+        if self.throttle():
+            return
+
+        playlist_id = parts[2]
+        total = self.server.playlists[playlist_id]
+        snapshot_id = f"{playlist_id}-{total}"
+
+        # playlist metadata (snapshot)
+        if len(parts) == 3:
+            etag = f'"{snapshot_id}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_json({"id": playlist_id, "snapshot_id": snapshot_id,
+                            "public": playlist_id not in self.server.private}, headers={"ETag": etag})
+            return
+
+        # tracks page, items are generated so huge playlists cost no memory
+        offset = int(query.get("offset", 0))
+        limit = min(int(query.get("limit", 100)), self.server.page_size)
+        items = [fake_track(i) for i in range(offset, min(offset + limit, total))]
+        self.send_json({"items": items, "total": total, "offset": offset, "limit": limit})
+
+    def log_message(self, format, *args):
+        pass # suppress server log
+
+
+def fake_track(i):
+    """Deterministic fake playlist item number i"""
+    return {"track": {
+        "id": f"track{i:07d}",
+        "name": f"Song {i}",
+        "artists": [{"id": f"artist{i % 997}", "name": f"Artist {i % 997}"}],
+        "album": {"id": f"album{i % 4999}", "name": f"Album {i % 4999}"},
+        "external_ids": {"isrc": f"USFAK{i:07d}"},
+        "track_number": i % 12 + 1,
+        "duration_ms": 180000,
+    }}
+
+def fake_file_url(base_url, track):
+    """resolve_url for the /files endpoint (module level, so worker processes can use it)"""
+    return f"{base_url}/files/{track['id']}"
+
+def fake_object_number(item_id, prefix):
+    """Number i of a generated ID like track0000042, None if not ours"""
+    if item_id.startswith(prefix) and item_id[len(prefix):].isdigit():
+        return int(item_id[len(prefix):])
+    return None
+
+def fake_full_track(item_id):
+    i = fake_object_number(item_id, "track")
+    return None if i is None else fake_track(i)["track"]
+
+def fake_album(item_id):
+    i = fake_object_number(item_id, "album")
+    if i is None:
+        return None
+    return {"id": item_id, "name": f"Album {i}", "release_date": f"{1960 + i % 60}-01-01",
+            "images": [{"url": f"https://i.example/{item_id}.jpg", "height": 640, "width": 640}]}
+
+def fake_artist(item_id):
+    i = fake_object_number(item_id, "artist")
+    if i is None:
+        return None
+    return {"id": item_id, "name": f"Artist {i}", "genres": [f"genre {i % 23}", f"genre {i % 7}"]}
+
+# objects served by the multi-ID endpoints
+FAKE_OBJECTS = {"tracks": fake_full_track, "albums": fake_album, "artists": fake_artist}
+
+def start_fake_spotify(playlists=None, latency=0.0, page_size=100, rate_429=0.0,
+                       expires_in=3600, file_size=256 * 1024, file_latency=0.0, seed=0, private=()):
+    """
+    Start fake Spotify server, `playlists` maps playlist id to track count,
+    the ones in `private` are not public
+    """
+    return start_server(
+        FakeSpotifyHandler,
+        playlists=playlists or {"fake": 1000},
+        private=set(private),
+        latency=latency,
+        page_size=page_size,
+        rate_429=rate_429,
+        expires_in=expires_in,
+        file_size=file_size,
+        file_latency=file_latency,
+        file_data=random.Random(seed).randbytes(file_size),
+        random=random.Random(seed),
+        lock=threading.Lock(),
+        requests=0,
+        throttled=0,
+        tokens_issued=0,
+    )
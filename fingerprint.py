@@ -0,0 +1,189 @@
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+# audio is decoded to mono 11 kHz, only the first minutes are used
+SAMPLE_RATE = 11025
+SECONDS = 120
+FRAME = 2048
+HOP = 1024
+
+# fingerprint: SEGMENTS x (BANDS - 1) bits = 1024 bits (128 bytes)
+BANDS = 17
+SEGMENTS = 64
+FP_BYTES = SEGMENTS * (BANDS - 1) // 8
+
+# banded LSH: 32 bands of 32 bits, songs sharing a band are compared
+LSH_BANDS = 32
+# max fraction of differing bits for a near duplicate (re-encodes flip a
+# few percent, unrelated songs about half)
+MAX_DISTANCE = 0.2
+# huge buckets (silence, broken files) are not worth comparing
+MAX_BUCKET = 64
+
+def decode_pcm(path, sample_rate=SAMPLE_RATE, seconds=SECONDS):
+    """Decode the start of an audio file to mono float samples (needs ffmpeg)"""
+    import numpy as np
+
+    command = ["ffmpeg", "-v", "quiet", "-i", str(path), "-t", str(seconds),
+               "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"]
+    result = subprocess.run(command, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32)
+
+def fingerprint(samples, sample_rate=SAMPLE_RATE):
+    """
+    Compact spectral fingerprint of PCM samples or None if too short.
+    Log band energies (300-3000 Hz) are averaged over SEGMENTS time
+    segments, every bit is the sign of the energy difference between
+    neighbouring bands and segments, which survives re-encoding and
+    volume changes.
+    """
+    import numpy as np
+
+    if len(samples) < FRAME + HOP * (SEGMENTS + 1):
+        return None
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(FRAME), axis=1)) ** 2
+
+    edges = (np.geomspace(300, 3000, BANDS + 1) * FRAME / sample_rate).astype(int)
+    energy = np.log(np.add.reduceat(spectrum, edges, axis=1)[:, :BANDS] + 1e-9)
+
+    # average the frames of SEGMENTS + 1 equal time segments
+    count = len(energy) // (SEGMENTS + 1) * (SEGMENTS + 1)
+    segments = energy[:count].reshape(SEGMENTS + 1, -1, BANDS).mean(axis=1)
+
+    band_diff = np.diff(segments, axis=1)
+    bits = np.diff(band_diff, axis=0) > 0
+    return np.packbits(bits).tobytes()
+
+def fingerprint_file(path):
+    """
+    Fingerprint of an audio file. Files that can't be decoded give b""
+    so they are not tried again until they change (a missing ffmpeg
+    raises FileNotFoundError instead).
+    """
+    try:
+        return fingerprint(decode_pcm(path)) or b""
+    except subprocess.CalledProcessError:
+        return b""
+
+def fingerprint_library(library, max_workers=None, chunksize=8, batch=256):
+    """
+    Fingerprint every song of a LibraryIndex that has none yet in a
+    process pool. Returns the number of files processed.
+    """
+    paths = library.unfingerprinted()
+    if not paths:
+        return 0
+    files = [str(library.root / path) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        rows = []
+        for path, blob in zip(paths, executor.map(fingerprint_file, files, chunksize=chunksize)):
+            rows.append((path, blob))
+            if len(rows) >= batch:
+                library.set_fingerprints(rows)
+                rows = []
+        library.set_fingerprints(rows)
+    return len(paths)
+
+
+class FingerprintIndex:
+    def __init__(self, fingerprints, max_distance=MAX_DISTANCE):
+        """
+        Near-duplicate lookup over (path, fingerprint) rows. Candidates
+        come from a banded LSH (equal 32 bit band), only those are
+        compared bit by bit, so there is no pairwise comparison.
+        """
+        import numpy as np
+
+        rows = [(path, blob) for path, blob in fingerprints if blob and len(blob) == FP_BYTES]
+        self.paths = [path for path, _ in rows]
+        self.matrix = np.frombuffer(b"".join(blob for _, blob in rows),
+                                    dtype=np.uint8).reshape(len(rows), FP_BYTES)
+        self.bands = self.matrix.view(np.uint32)
+        self.max_bits = int(max_distance * FP_BYTES * 8)
+        # per band lookup of the rows sharing a value, built on the first query
+        self.buckets = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def distances(self, rows, others):
+        """Number of differing bits between fingerprint rows"""
+        import numpy as np
+        return np.unpackbits(self.matrix[rows] ^ self.matrix[others], axis=1).sum(axis=1)
+
+    def build_buckets(self):
+        """
+        LSH buckets, one dict per band: band value -> (start, size) of
+        its rows in that band's sorted row order
+        """
+        import numpy as np
+
+        self.buckets = []
+        for band in range(LSH_BANDS):
+            values = self.bands[:, band]
+            order = np.argsort(values, kind="stable")
+            unique, starts, sizes = np.unique(values[order], return_index=True, return_counts=True)
+            self.buckets.append((order, dict(zip(unique.tolist(), zip(starts.tolist(), sizes.tolist())))))
+
+    def query(self, blob):
+        """Path of the closest near duplicate of a fingerprint or None"""
+        import numpy as np
+
+        if not blob or len(blob) != FP_BYTES or not self.paths:
+            return None
+        if self.buckets is None:
+            self.build_buckets()
+        query = np.frombuffer(blob, dtype=np.uint8)
+        # only the songs sharing a bucket with the query are compared,
+        # oversized buckets (e.g. silence) are skipped
+        found = []
+        for (order, bucket), value in zip(self.buckets, query.view(np.uint32).tolist()):
+            start, size = bucket.get(value, (0, 0))
+            if 0 < size <= MAX_BUCKET:
+                found.append(order[start:start + size])
+        if not found:
+            return None
+        candidates = np.unique(np.concatenate(found))
+        distances = np.unpackbits(self.matrix[candidates] ^ query, axis=1).sum(axis=1)
+        best = distances.argmin()
+        return self.paths[candidates[best]] if distances[best] <= self.max_bits else None
+
+    def duplicates(self):
+        """Groups (lists of paths) of songs that are the same recording"""
+        import numpy as np
+
+        # candidate pairs: rows with the same value in one of the bands
+        pairs = set()
+        for band in range(LSH_BANDS):
+            values = self.bands[:, band]
+            order = np.argsort(values, kind="stable")
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(values[order])) + 1, [len(order)]))
+            sizes = np.diff(bounds)
+            # only buckets holding more than one song
+            for start in bounds[:-1][(sizes > 1) & (sizes <= MAX_BUCKET)].tolist():
+                bucket = order[start:bounds[np.searchsorted(bounds, start) + 1]]
+                bucket = sorted(bucket.tolist())
+                pairs.update((a, b) for i, a in enumerate(bucket) for b in bucket[i + 1:])
+        if not pairs:
+            return []
+
+        first, second = np.array(sorted(pairs)).T
+        close = self.distances(first, second) <= self.max_bits
+
+        # union-find over the close pairs
+        parent = list(range(len(self.paths)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for a, b in zip(first[close].tolist(), second[close].tolist()):
+            parent[find(a)] = find(b)
+
+        groups = {}
+        for i in set(first[close].tolist()) | set(second[close].tolist()):
+            groups.setdefault(find(i), []).append(self.paths[i])
+        return [sorted(group) for group in groups.values()]
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import ctypes
+import select
+import struct
+import threading
+from pathlib import Path
+from local_library import AUDIO_EXTENSIONS
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+class Inotify:
+    def __init__(self):
+        """Minimal inotify binding (ctypes, Linux only)"""
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        return wd
+
+    def read(self):
+        """All queued events as (wd, mask, name) without blocking"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    def __init__(self, library, quiet=0.2, max_delay=2.0):
+        """
+        Keep a LibraryIndex current with inotify: every library folder is
+        watched and changed folders are collected. A burst of events is
+        applied with one update_dirs() call once there were no new events
+        for `quiet` seconds (at the latest after `max_delay`).
+        """
+        self.library = library
+        self.root = Path(library.root)
+        self.quiet = quiet
+        self.max_delay = max_delay
+
+        self.inotify = None
+        self.watches = {}
+        self.dirty = set()
+        self.rescan = False
+        self.first_event = None
+        self.last_event = None
+        self.lock = threading.Lock()
+        # events read by one thread are applied before another flushes
+        self.flush_lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.updates = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Watch the library folders (raises OSError without inotify)"""
+        self.inotify = Inotify()
+        try:
+            self.watch_tree(".")
+        except OSError:
+            # e.g. out of inotify watches (fs.inotify.max_user_watches)
+            self.inotify.close()
+            raise
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch_tree(self, rel_dir):
+        """Add watches for a folder and its (not hidden) subfolders"""
+        for folder, dirs, _ in os.walk(self.root / rel_dir):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            try:
+                wd = self.inotify.add_watch(folder)
+            except FileNotFoundError:
+                continue
+            self.watches[wd] = os.path.normpath(os.path.relpath(folder, self.root))
+
+    def handle(self, events):
+        """Turn raw events into dirty folders"""
+        now = time.monotonic()
+        with self.lock:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, only a scan can catch up
+                    self.rescan = True
+                    continue
+                rel_dir = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if rel_dir is None or name.startswith("."):
+                    continue
+
+                if mask & IN_ISDIR:
+                    path = os.path.normpath(os.path.join(rel_dir, name))
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.watch_tree(path)
+                        self.dirty.add(path)
+                elif name and Path(name).suffix.lower() not in AUDIO_EXTENSIONS:
+                    # .part files and other non audio files
+                    continue
+                self.dirty.add(rel_dir)
+
+                self.first_event = self.first_event or now
+                self.last_event = now
+
+    def take(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.first_event = self.last_event = None
+            return dirty
+
+    def flush(self):
+        """Apply every change seen so far (including unread events) now"""
+        with self.flush_lock:
+            self.handle(self.inotify.read())
+            if self.rescan:
+                self.rescan = False
+                self.take()
+                self.library.scan()
+                return
+            dirty = self.take()
+            if dirty:
+                self.library.update_dirs(dirty)
+                self.updates += 1
+
+    def run(self):
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.inotify.fd], [], [], self.quiet / 2)
+            if readable:
+                with self.flush_lock:
+                    self.handle(self.inotify.read())
+
+            # coalesce bursts: wait for a quiet moment
+            with self.lock:
+                due = self.last_event is not None and (
+                    time.monotonic() - self.last_event >= self.quiet
+                    or time.monotonic() - self.first_event >= self.max_delay)
+            if due or self.rescan:
+                self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.inotify.close()
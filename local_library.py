@@ -0,0 +1,344 @@
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".m4a", ".ogg", ".opus", ".wav", ".aac"}
+# the index lives in its own folder so SQLite's journal files don't
+# change the mtime of the library root
+INDEX_DIR = ".library"
+INDEX_FILE = "index.db"
+
+# "(feat X)", "[ft. X]", "(featuring X)" or a trailing "feat. X" / "ft. X",
+# a bare "feat" is a word ("Feat of Clay")
+FEAT_PATTERN = re.compile(r"[\(\[]\s*(feat|ft|featuring)\b.*?([\)\]]|$)|\b(feat|ft)\..*$",
+                          re.IGNORECASE)
+
+# bumped whenever normalize_key / song_key change, stored keys are
+# recomputed on open
+SCHEMA_VERSION = 2
+
+def normalize_key(text):
+    """
+    Normalize a title/artist for lookups: unicode folded, lower case,
+    "feat." parts, accents and punctuation removed, whitespace collapsed.
+    """
+    if not text:
+        return ""
+    # decompose accents and drop the combining marks
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    text = text.casefold()
+    # drop featured artists: "Song (feat. X)", "Song ft. X"
+    if "ft" in text or "feat" in text:
+        text = FEAT_PATTERN.sub("", text)
+    # punctuation -> space, then collapse spaces
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+def parse_filename(name):
+    """
+    Split a file name into (title, artist). Only the extension is
+    removed so "Mr. Brightside.mp3" stays "Mr. Brightside".
+    Files named "Artist - Title.ext" also give us the artist.
+    """
+    stem = Path(name).stem
+    if " - " in stem:
+        artist, title = stem.split(" - ", 1)
+        return title.strip(), artist.strip()
+    return stem.strip(), None
+
+def song_key(title, artist=None):
+    """Lookup key for a song, artist is optional"""
+    if artist:
+        return f"{normalize_key(artist)}|{normalize_key(title)}"
+    return normalize_key(title)
+
+
+class LibraryIndex:
+    def __init__(self, root=".", index_file=INDEX_FILE):
+        """
+        Persistent index of the local library stored as SQLite inside the
+        target folder. Files are keyed by path with size/mtime and only
+        directories whose mtime changed are listed again on a rescan.
+        """
+        self.root = Path(root)
+        self.index_dir = self.root / INDEX_DIR
+        self.index_dir.mkdir(exist_ok=True)
+        self.db_path = self.index_dir / index_file
+        # shared by the scheduler/pipeline threads, access goes through the lock
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.create_tables()
+
+        # in memory maps for O(1) lookups, filled by load()
+        self.by_key = {}
+        self.by_title = {}
+        # files without an artist in their name
+        self.by_bare_title = {}
+        self.by_id = {}
+        self.songs_cache = None
+
+    def create_tables(self):
+        """Create index tables if they don't exist yet"""
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                dir TEXT,
+                size INTEGER,
+                mtime REAL,
+                title TEXT,
+                artist TEXT,
+                key TEXT,
+                title_key TEXT,
+                spotify_id TEXT,
+                isrc TEXT,
+                fingerprint BLOB
+            );
+            CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+            CREATE INDEX IF NOT EXISTS files_key ON files(key);
+            CREATE INDEX IF NOT EXISTS files_spotify_id ON files(spotify_id);
+        """)
+        # indexes created before acoustic fingerprints
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "fingerprint" not in columns:
+            self.conn.execute("ALTER TABLE files ADD COLUMN fingerprint BLOB")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self.rekey()
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
+    def rekey(self):
+        """Recompute the lookup keys of every file (normalization changed)"""
+        rows = self.conn.execute("SELECT path, title, artist FROM files").fetchall()
+        self.conn.executemany(
+            "UPDATE files SET key = ?, title_key = ? WHERE path = ?",
+            [(song_key(title, artist), normalize_key(title), path) for path, title, artist in rows])
+
+    def scan(self, full=False):
+        """
+        Bring the index up to date. Returns the number of directories
+        that were actually listed.
+        """
+        with self.lock:
+            return self.scan_locked(full)
+
+    def scan_locked(self, full):
+        known_dirs = dict(self.conn.execute("SELECT path, mtime FROM dirs"))
+        seen_dirs = set()
+        rescanned = 0
+
+        stack = ["."]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = self.root / rel_dir
+            try:
+                mtime = os.stat(abs_dir).st_mtime
+            except FileNotFoundError:
+                continue
+            seen_dirs.add(rel_dir)
+
+            # unchanged directory: reuse the stored children
+            if not full and known_dirs.get(rel_dir) == mtime:
+                stack.extend(row[0] for row in self.conn.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (rel_dir,)))
+                continue
+
+            rescanned += 1
+            stack.extend(self.scan_dir(rel_dir, abs_dir, mtime))
+
+        # drop directories (and their files) that disappeared
+        for rel_dir in set(known_dirs) - seen_dirs:
+            self.conn.execute("DELETE FROM dirs WHERE path = ?", (rel_dir,))
+            self.conn.execute("DELETE FROM files WHERE dir = ?", (rel_dir,))
+
+        self.conn.commit()
+        self.load()
+        return rescanned
+
+    def scan_dir(self, rel_dir, abs_dir, mtime):
+        """List one directory with os.scandir and update its rows"""
+        stored = {path: (size, file_mtime) for path, size, file_mtime in self.conn.execute(
+            "SELECT path, size, mtime FROM files WHERE dir = ?", (rel_dir,))}
+        subdirs = []
+        present = set()
+
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                rel_path = os.path.normpath(os.path.join(rel_dir, entry.name))
+                if entry.is_dir(follow_symlinks=False):
+                    # hidden folders (index, track store) are not part of the library
+                    if not entry.name.startswith("."):
+                        subdirs.append(rel_path)
+                    continue
+                if not entry.is_file() or Path(entry.name).suffix.lower() not in AUDIO_EXTENSIONS:
+                    continue
+
+                present.add(rel_path)
+                stat = entry.stat()
+                # skip files that did not change
+                if stored.get(rel_path) == (stat.st_size, stat.st_mtime):
+                    continue
+
+                title, artist = parse_filename(entry.name)
+                self.conn.execute(
+                    """INSERT INTO files (path, dir, size, mtime, title, artist, key, title_key)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                       title = excluded.title, artist = excluded.artist, key = excluded.key,
+                       title_key = excluded.title_key, fingerprint = NULL""",
+                    (rel_path, rel_dir, stat.st_size, stat.st_mtime, title, artist,
+                     song_key(title, artist), normalize_key(title)))
+
+        # remove files that are gone from this directory
+        for rel_path in set(stored) - present:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+
+        # forget children that were removed, the rest of their tree is
+        # cleaned up at the end of scan()
+        old_subdirs = {row[0] for row in self.conn.execute(
+            "SELECT path FROM dirs WHERE parent = ?", (rel_dir,))}
+        for subdir in old_subdirs - set(subdirs):
+            self.conn.execute("DELETE FROM dirs WHERE path = ?", (subdir,))
+        # mtime NULL forces the first scan of new subdirectories
+        for subdir in set(subdirs) - old_subdirs:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, NULL)",
+                (subdir, rel_dir))
+
+        parent = (os.path.dirname(rel_dir) or ".") if rel_dir != "." else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)",
+            (rel_dir, parent, mtime))
+
+        return subdirs
+
+    def update_dirs(self, rel_dirs):
+        """
+        Rescan only the given directories, e.g. the ones a watcher saw
+        change. New subdirectories are listed as well, removed ones are
+        dropped with everything below them. Returns the number of
+        directories listed.
+        """
+        with self.lock:
+            known_dirs = dict(self.conn.execute("SELECT path, mtime FROM dirs"))
+            stack = list(rel_dirs)
+            rescanned = 0
+            while stack:
+                rel_dir = os.path.normpath(stack.pop())
+                abs_dir = self.root / rel_dir
+                try:
+                    mtime = os.stat(abs_dir).st_mtime
+                except FileNotFoundError:
+                    self.forget_dir(rel_dir)
+                    continue
+
+                old_subdirs = {row[0] for row in self.conn.execute(
+                    "SELECT path FROM dirs WHERE parent = ?", (rel_dir,))}
+                subdirs = self.scan_dir(rel_dir, abs_dir, mtime)
+                rescanned += 1
+                for subdir in old_subdirs - set(subdirs):
+                    self.forget_dir(subdir)
+                # subdirectories we never listed
+                stack.extend(subdir for subdir in subdirs if known_dirs.get(subdir) is None)
+
+            self.conn.commit()
+            if rescanned or rel_dirs:
+                self.load()
+            return rescanned
+
+    def forget_dir(self, rel_dir):
+        """Drop a directory and everything below it from the index"""
+        prefix = rel_dir + os.sep
+        for table, column in (("dirs", "path"), ("files", "dir")):
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE {column} = ? OR substr({column}, 1, ?) = ?",
+                (rel_dir, len(prefix), prefix))
+
+    def load(self):
+        """Load lookup maps from the index"""
+        self.songs_cache = None
+        self.by_key = {}
+        self.by_title = {}
+        self.by_bare_title = {}
+        self.by_id = {}
+        for path, key, title_key, spotify_id in self.conn.execute(
+                "SELECT path, key, title_key, spotify_id FROM files"):
+            self.by_key.setdefault(key, path)
+            self.by_title.setdefault(title_key, path)
+            if key == title_key:
+                self.by_bare_title.setdefault(title_key, path)
+            if spotify_id:
+                self.by_id[spotify_id] = path
+
+    def lookup(self, title, artist=None):
+        """
+        Path of a local song by title/artist or None. With an artist the
+        title alone only matches files that name no artist.
+        """
+        if artist:
+            return self.by_key.get(song_key(title, artist)) or self.by_bare_title.get(normalize_key(title))
+        return self.by_title.get(normalize_key(title))
+
+    def lookup_id(self, spotify_id):
+        """Path of a local song by Spotify track ID or None"""
+        return self.by_id.get(spotify_id)
+
+    def set_spotify_id(self, path, spotify_id, isrc=None):
+        """Remember which Spotify track a local file belongs to"""
+        rel_path = os.path.normpath(os.path.relpath(path, self.root)) if os.path.isabs(path) else os.path.normpath(path)
+        with self.lock:
+            self.conn.execute("UPDATE files SET spotify_id = ?, isrc = COALESCE(?, isrc) WHERE path = ?",
+                              (spotify_id, isrc, rel_path))
+            self.conn.commit()
+            self.songs_cache = None
+        self.by_id[spotify_id] = rel_path
+
+    def songs(self):
+        """
+        All indexed songs as (path, key, title_key, spotify_id, isrc)
+        rows, cached until the index changes.
+        """
+        with self.lock:
+            if self.songs_cache is None:
+                self.songs_cache = self.conn.execute(
+                    "SELECT path, key, title_key, spotify_id, isrc FROM files").fetchall()
+            return self.songs_cache
+
+    def unfingerprinted(self):
+        """Paths of the songs without acoustic fingerprint"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM files WHERE fingerprint IS NULL")]
+
+    def set_fingerprints(self, rows):
+        """Store (path, fingerprint) rows, b"" marks files that can't be decoded"""
+        with self.lock:
+            self.conn.executemany("UPDATE files SET fingerprint = ? WHERE path = ?",
+                                  [(blob, path) for path, blob in rows])
+            self.conn.commit()
+
+    def fingerprints(self):
+        """(path, fingerprint) of all fingerprinted songs"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT path, fingerprint FROM files WHERE length(fingerprint) > 0").fetchall()
+
+    def has_fingerprints(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM files WHERE length(fingerprint) > 0 LIMIT 1").fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,103 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+def expected_tags(track):
+    """Tags a file should carry according to the Spotify track data"""
+    track = track.get("track", track)
+    artists = track.get("artists") or []
+    tags = {
+        "title": track.get("name"),
+        "artist": ", ".join(a["name"] for a in artists if a.get("name")),
+        "album": (track.get("album") or {}).get("name"),
+        "tracknumber": str(track["track_number"]) if track.get("track_number") else None,
+        "isrc": (track.get("external_ids") or {}).get("isrc"),
+        # filled by batch_loader.Enricher
+        "date": (track.get("album") or {}).get("release_date"),
+        "genre": (track.get("genres") or [None])[0],
+    }
+    return {key: value for key, value in tags.items() if value}
+
+def keep_padding(info):
+    """
+    mutagen padding callback: if the new tags fit in the existing padding
+    the tag region is rewritten in place, otherwise use the default.
+    """
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+def open_tags(path):
+    """Open file with mutagen's easy interface (None if unsupported)"""
+    import mutagen
+    from mutagen.easyid3 import EasyID3
+    from mutagen.id3 import ID3NoHeaderError
+
+    if str(path).lower().endswith(".mp3"):
+        try:
+            return EasyID3(path)
+        except ID3NoHeaderError:
+            # untagged mp3: start with an empty tag
+            audio = EasyID3()
+            audio.filename = path
+            return audio
+    return mutagen.File(path, easy=True)
+
+def tag_file(path, tags):
+    """
+    Write tags to one file. Files that already carry the right tags
+    are left untouched. Returns "tagged", "skipped" or "failed".
+    """
+    try:
+        audio = open_tags(path)
+        if audio is None:
+            return "failed"
+
+        if getattr(audio, "tags", True) is None:
+            audio.add_tags()
+
+        # compare first, keys the container doesn't support are dropped
+        changed = False
+        for key, value in tags.items():
+            if (audio.get(key) or [None])[0] == value:
+                continue
+            try:
+                audio[key] = value
+                changed = True
+            except (KeyError, ValueError):
+                pass
+
+        if not changed:
+            return "skipped"
+
+        try:
+            audio.save(path, padding=keep_padding)
+        except TypeError:
+            # formats without padding support
+            audio.save(path)
+        return "tagged"
+    except Exception as e:
+        print(f"Tagging {path} failed: {e}")
+        return "failed"
+
+def _tag_item(item):
+    return tag_file(*item)
+
+def tag_results(items, max_workers=None, chunksize=16):
+    """
+    Tag many files in a process pool. `items` are (path, tags) pairs,
+    returns the result of every item in order.
+    """
+    items = list(items)
+    max_workers = max_workers or os.cpu_count()
+
+    # not worth starting processes for a handful of files
+    if len(items) < 2 * chunksize or max_workers == 1:
+        return [_tag_item(item) for item in items]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_tag_item, items, chunksize=chunksize))
+
+def tag_files(items, max_workers=None, chunksize=16):
+    """Tag many files (see tag_results), returns a Counter of the results"""
+    return Counter(tag_results(items, max_workers=max_workers, chunksize=chunksize))
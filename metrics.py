@@ -0,0 +1,150 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    def __init__(self):
+        """
+        Process wide counters, stage timers and latency histograms.
+        Metric names follow Prometheus conventions, labels are passed
+        as keyword arguments.
+        """
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Add a duration to a histogram"""
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                                    "buckets": [0] * len(BUCKETS)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of the sync run: `with metrics.stage("scan"): ...`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=name)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_dict(self):
+        """Metrics as plain dict (for --metrics json)"""
+        def label_name(name, labels):
+            if not labels:
+                return name
+            return name + "{" + ",".join(f"{key}={value}" for key, value in labels) + "}"
+
+        with self.lock:
+            counters = {label_name(*key): value for key, value in self.counters.items()}
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[label_name(*key)] = {
+                    "count": histogram["count"],
+                    "total": round(histogram["sum"], 6),
+                    "mean": round(histogram["sum"] / histogram["count"], 6),
+                    "max": round(histogram["max"], 6),
+                }
+
+        # cache hit rates
+        for cache in {name.split("_cache_")[0] for name in counters if "_cache_" in name}:
+            hits = counters.get(f"{cache}_cache_hits_total", 0)
+            misses = counters.get(f"{cache}_cache_misses_total", 0)
+            if hits + misses:
+                counters[f"{cache}_cache_hit_rate"] = round(hits / (hits + misses), 4)
+
+        return {"counters": counters, "histograms": histograms}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{labels_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{labels_text(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{labels_text(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{labels_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """Serve /metrics in a background thread (used by the scheduler)"""
+        from http.server import ThreadingHTTPServer
+        server = ThreadingHTTPServer((host, port), metrics_handler())
+        server.metrics = self
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return server
+
+
+def metrics_handler():
+    """
+    Prometheus scrape endpoint. Built on demand so http.server is only
+    imported when metrics are served.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = self.server.metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # suppress server log
+
+    return MetricsHandler
+
+
+# shared instance used by all modules
+metrics = Metrics()
@@ -1,17 +1,24 @@
 import os
 import sys 
 import json
+import time
 import argparse
-from auth_api import SpotifyOAuth, SpotifyAPI
+import threading
+from metrics import metrics
 from pathlib import Path
-from dotenv import load_dotenv
+
+# heavy modules (requests, dotenv, sqlite3, http.server...) are imported
+# where they are used so `--help` and the usage message start fast
 
 class MusicDownloader:
-    def __init__(self, test=False, config_file="configuration.json", extra=None, dest_file=None):
+    def __init__(self, test=False, config_file="configuration.json", extra=None, dest_file=None, playlists=None):
+        # guards the lazily created library index and track store, the
+        # daemon syncs several playlists at once
+        self.lock = threading.Lock()
         # standard setup when not testing:
         if not test:
             # load previous configurations
-            self.load_config(config_file=config_file, dest_file=dest_file)
+            self.load_config(config_file=config_file, dest_file=dest_file, playlists=playlists)
             # change wdir to target directory and store dir
             self.target_folder = self.set_wdir(extra=extra)
 
@@ -32,24 +39,34 @@ class MusicDownloader:
         return home / "Desktop"
                 
     
-    def load_config(self, config_file="conjugurations.json", dest_file=None):
+    def load_config(self, config_file="conjugurations.json", dest_file=None, playlists=None):
         """setup or load configutation file"""
 
         if os.path.exists(config_file):
             with open(config_file, "r+") as fhand:
                     self.state = json.load(fhand)
+            # configurations written before playlists were stored
+            self.state.setdefault("playlists", [])
                     
-            # change target folder and save info
-            if dest_file:
-                self.state["local_file"] = dest_file
-                with open(config_file, "w") as fhand:
-                    json.dump(self.state, fhand)
+            # change target folder / playlists and save info
+            if dest_file or playlists:
+                if dest_file:
+                    self.state["local_file"] = dest_file
+                if playlists:
+                    self.state["playlists"] = playlists
+                self.save_config(config_file)
         # initialize configurations
         else:
-            self.state = {"local_folder": dest_file}
+            self.state = {"local_folder": dest_file, "playlists": playlists or []}
             # save configuration
-            with open(config_file, "w") as fhand:
-                json.dump(self.state, fhand)
+            self.save_config(config_file)
+
+    def save_config(self, config_file):
+        """Write the configuration atomically so a crash can't truncate it"""
+        temp_file = f"{config_file}.tmp"
+        with open(temp_file, "w") as fhand:
+            json.dump(self.state, fhand)
+        os.replace(temp_file, config_file)
     
     def set_wdir(self, extra=None):
         """Set working directory to target directory"""
@@ -68,35 +85,512 @@ class MusicDownloader:
 
         return target_dir
 
-    def get_local_songs(self):
-        """Extract local songs"""
+    def get_local_songs(self, full=False):
+        """
+        Update the local library index of the target folder. Only
+        directories that changed since the last run are listed again,
+        with a running watcher (see watch_library) only the changes it
+        saw are applied.
+        """
+        from local_library import LibraryIndex
+
+        folder = getattr(self, "target_folder", Path("."))
+        watcher = getattr(self, "watcher", None)
+        with metrics.stage("local_scan"):
+            with self.lock:
+                if getattr(self, "library", None) is None:
+                    self.library = LibraryIndex(folder)
+            if watcher is not None and watcher.running and not full:
+                watcher.flush()
+            else:
+                self.library.scan(full=full)
+
+        # normalized title keys of every local song
+        self.local_songs = self.library.by_title
+        return self.library
 
-        self.local_songs = []
+    def watch_library(self):
+        """
+        Keep the library index current with inotify (Linux) while the
+        program runs, so the local side of a sync costs nothing. Returns
+        False if the folder can't be watched (scans are used then).
+        """
+        from local_library import LibraryIndex
+        from library_watcher import LibraryWatcher
 
-        # iterate over local files 
-        for file in Path(".").iterdir():
-            if file.is_file():
-                # extract song name and added it to local files
-                self.local_songs.append(file.name.split(".")[0])
+        if getattr(self, "library", None) is None:
+            self.library = LibraryIndex(getattr(self, "target_folder", Path(".")))
+        watcher = LibraryWatcher(self.library)
+        try:
+            watcher.start()
+        except OSError as e:
+            print(f"Library watcher not available ({e}), scanning instead")
+            return False
+        self.watcher = watcher
+        # watches are in place, catch up with what changed before
+        self.library.scan()
+        return True
+
+    def match_songs(self, spotify_plist) -> list:
+        """
+        Match the songs of a Spotify playlist against the local library,
+        returns (item, tier, path) per song, tier and path are None for
+        songs to download.
+        """
+        from song_matcher import SongMatcher
+
+        # cheap: only changed folders are listed (or the watcher's changes applied)
+        self.get_local_songs()
+
+        with metrics.stage("diff"):
+            matcher = SongMatcher(self.library.songs())
+            return matcher.diff(spotify_plist)
 
-        
     def get_songs_list(self, spotify_plist) -> list:
         """
         Find the songs that are in the Spotify playlist but not
         in the local file. This are the songs to be downloaded.
+        The full match report of the last call is kept in self.matches
+        (concurrent syncs use match_songs).
         """
+        self.matches = self.match_songs(spotify_plist)
+        return [item for item, tier, path in self.matches if tier is None]
 
+    def download_songs(self, jobs, max_workers=8, per_host=4, on_complete=None):
+        """Download jobs into the target folder"""
+        from downloader import DownloadScheduler
 
-    def edit_song_metadata():
-        """Edit the song Meta data to correclty"""
-        pass
+        scheduler = DownloadScheduler(self.target_folder, max_workers=max_workers, per_host=per_host)
+        with metrics.stage("download"):
+            return scheduler.run(jobs, on_complete=on_complete)
+
+    def song_filename(self, track, extension=".mp3"):
+        """File name for a Spotify track (Artist - Title.mp3)"""
+        track = track.get("track", track)
+        artists = track.get("artists") or []
+        name = track.get("name", "")
+        if artists:
+            name = f"{artists[0]['name']} - {name}"
+        # remove characters not allowed in file names
+        name = "".join(c for c in name if c not in '<>:"/\\|?*')
+        return name.strip() + extension
+
+    def get_resolver(self, resolve_url):
+        """
+        Wrap a resolve_url(track) function in the persistent source cache,
+        so re-syncs and tracks shared by playlists are resolved once.
+        """
+        from source_cache import CachedResolver
+
+        if resolve_url is None or isinstance(resolve_url, CachedResolver):
+            return resolve_url
+        return CachedResolver(resolve_url)
+
+    def plan_entry(self, track, planned, used):
+        """
+        Entry {key, track, filename} of a track to download, keyed by
+        Spotify ID (the song's file name without one). `planned` maps keys
+        to their file names: a planned key keeps its name, a new one gets
+        the first free one of "Artist - Title.mp3", "Artist - Title (2).mp3",
+        ... and is added. `used` holds the (casefolded) names taken.
+        """
+        from playlist_cache import slim_track
+
+        track = slim_track({"track": track.get("track", track)})
+        base = self.song_filename(track, extension="")
+        key = track["id"] or f"{base}.mp3"
+        filename = planned.get(key)
+        if filename is None:
+            filename, number = f"{base}.mp3", 2
+            while filename.casefold() in used:
+                filename, number = f"{base} ({number}).mp3", number + 1
+            planned[key] = filename
+            used.add(filename.casefold())
+        return {"key": key, "track": track, "filename": filename}
+
+    def plan_entries(self, tracks, planned=None):
+        """
+        Entries for tracks to download (see plan_entry). A track listed
+        twice is planned once; different tracks with the same artist and
+        title get different file names, so they never share a download.
+        `planned` maps the keys of an earlier plan to their file names,
+        those tracks keep their name and new ones avoid it.
+        """
+        planned = dict(planned or {})
+        used = {filename.casefold() for filename in planned.values()}
+        entries = {}
+        for track in tracks:
+            entry = self.plan_entry(track, planned, used)
+            entries.setdefault(entry["key"], entry)
+        return list(entries.values())
+
+    def get_journal(self):
+        """Sync journal of the target folder (opened on first use)"""
+        from sync_journal import SyncJournal
+
+        if getattr(self, "journal", None) is None:
+            self.journal = SyncJournal(getattr(self, "target_folder", Path(".")))
+        return self.journal
+
+    def sync_playlist(self, tracks, resolve_url=None, playlist_id=None):
+        """
+        Incremental sync of one playlist: diff against the local library
+        and download the missing songs. `resolve_url(track)` returns the
+        download URL of a track (or None if there is no source).
+
+        With a `playlist_id` every step is recorded in the sync journal.
+        If the last run of the playlist was interrupted it is resumed from
+        the journal instead (`tracks` may be None): no diff, and songs
+        already downloaded are not fetched again.
+        """
+        from downloader import DownloadJob
+        from sync_journal import PLANNED, DOWNLOADING, DONE, TAGGED, FAILED, FINISHED
+
+        if resolve_url is None:
+            return self.get_songs_list(tracks)
+        resolve_url = self.get_resolver(resolve_url)
+
+        journal = self.get_journal() if playlist_id else None
+        pending = journal.pending(playlist_id) if journal else None
+
+        # plan: songs missing locally
+        if pending is None:
+            missing = self.get_songs_list(tracks)
+            pending = []
+            if journal:
+                journal.start(playlist_id)
+            for record in self.plan_entries(missing):
+                record["state"] = PLANNED
+                if journal:
+                    journal.record(playlist_id, record["key"], PLANNED,
+                                   track=record["track"], filename=record["filename"])
+                pending.append(record)
+
+        def record(entry, state, **fields):
+            entry["state"] = state
+            if journal:
+                journal.record(playlist_id, entry["key"], state, **fields)
+
+        # resolve and download, finished downloads are skipped on resume
+        jobs, entries = [], {}
+        for entry in pending:
+            if entry["state"] == PLANNED:
+                url = resolve_url(entry["track"])
+                if not url:
+                    record(entry, FAILED, error="no source")
+                    continue
+                entry["url"] = url
+                record(entry, DOWNLOADING, url=url)
+            if entry["state"] == DOWNLOADING:
+                jobs.append(DownloadJob(entry["url"], entry["filename"], track_id=entry["track"]["id"]))
+                # jobs carry the track ID and the (unique) file name
+                entries[entry["track"]["id"] or entry["filename"]] = entry
+
+        def on_complete(job):
+            entry = entries[job.track_id or job.filename]
+            if job.status in ("done", "skipped"):
+                record(entry, DONE)
+            else:
+                # the cached source may be gone
+                resolve_url.invalidate(job.track_id)
+                record(entry, FAILED, error=job.error)
+
+        jobs = self.download_songs(jobs, on_complete=on_complete)
+
+        # rescan only picks up the folders that changed
+        self.get_local_songs()
+        for job in jobs:
+            if job.status == "done" and job.track_id:
+                self.library.set_spotify_id(job.path, job.track_id)
+
+        # new songs we already hold under another name
+        duplicates = self.dedupe_downloads(jobs)
+        for entry in pending:
+            if entry["state"] == DONE and entry["filename"] in duplicates:
+                entry["filename"] = duplicates[entry["filename"]]
+                record(entry, DONE, filename=entry["filename"])
+
+        # tag the new songs
+        done = [entry for entry in pending if entry["state"] == DONE]
+        results = self.tag_songs([(entry["track"], entry["filename"]) for entry in done])
+        for entry, result in zip(done, results):
+            if result == "failed":
+                record(entry, FAILED, error="tagging")
+            else:
+                record(entry, TAGGED)
+
+        if journal:
+            for entry in pending:
+                if entry["state"] not in FINISHED:
+                    record(entry, FAILED, error="unfinished")
+            journal.end(playlist_id)
+        return jobs
+
+    def plan_sync(self, tracks, queue, playlist_id=None):
+        """
+        Diff a playlist against the local library and add the missing
+        songs to a shared work queue (work_queue.WorkQueue), to be
+        downloaded by work_sync workers on this or other hosts.
+        Items keep their file name when planned again, new ones get
+        names unique across the queue (see plan_entries).
+        Returns the number of items queued.
+        """
+        entries = self.plan_entries(self.get_songs_list(tracks), planned=queue.filenames())
+        return queue.plan(playlist_id, entries)
+
+    def work_sync(self, queue, resolve_url, worker=None, batch=None, max_workers=8, poll=1.0):
+        """
+        Work on a shared sync plan (see plan_sync) until it is finished:
+        claim a batch, resolve, download into the target folder and tag,
+        then report every item. Workers sharing the queue and the target
+        folder split the plan; the items of a worker that dies are taken
+        over once its lease ran out. The library index is left to the
+        planner's next scan. Returns counts of this worker's results.
+
+        Claims are small (twice the download concurrency by default), so
+        workers run out of work together at the end of the plan.
+        """
+        from downloader import DownloadJob
+        from work_queue import DONE, FAILED, Heartbeat, worker_name
+
+        worker = worker or worker_name()
+        batch = batch or 2 * max_workers
+        resolve_url = self.get_resolver(resolve_url)
+        results = {DONE: 0, FAILED: 0, "lost": 0}
+
+        def report(item, state, error=None, retry=False):
+            if state == DONE:
+                owned = queue.complete(worker, item["key"])
+            else:
+                owned = queue.fail(worker, item["key"], error, retry=retry)
+            results[state if owned else "lost"] += 1
+
+        with Heartbeat(queue, worker):
+            try:
+                while True:
+                    items = queue.claim(worker, batch)
+                    if not items:
+                        if queue.finished():
+                            return results
+                        # other workers hold the rest, one of them may die
+                        time.sleep(poll)
+                        continue
+
+                    jobs, claimed = [], {}
+                    for item in items:
+                        try:
+                            url = resolve_url(item["track"])
+                        except Exception as e:
+                            report(item, FAILED, error=str(e), retry=True)
+                            continue
+                        if not url:
+                            report(item, FAILED, error="no source")
+                            continue
+                        jobs.append(DownloadJob(url, item["filename"], track_id=item["track"]["id"]))
+                        # jobs carry the track ID and the (unique) file name
+                        claimed[item["track"]["id"] or item["filename"]] = item
+
+                    def on_complete(job):
+                        item = claimed[job.track_id or job.filename]
+                        if job.status not in ("done", "skipped"):
+                            # the cached source may be gone
+                            resolve_url.invalidate(job.track_id)
+                            report(item, FAILED, error=job.error, retry=True)
+                        # tagged as it lands, overlapping the other downloads
+                        elif self.tag_songs([(item["track"], item["filename"])]) == ["failed"]:
+                            report(item, FAILED, error="tagging")
+                        else:
+                            report(item, DONE)
+
+                    self.download_songs(jobs, max_workers=max_workers, on_complete=on_complete)
+            except BaseException:
+                # hand the claimed items on right away instead of after the lease
+                queue.release(worker)
+                raise
+
+    def find_duplicates(self, max_workers=None):
+        """
+        Fingerprint the local library (only songs that changed since the
+        last run) and return groups of files holding the same recording.
+        Needs NumPy and ffmpeg.
+        """
+        from fingerprint import FingerprintIndex, fingerprint_library
+
+        if getattr(self, "library", None) is None:
+            self.get_local_songs()
+        with metrics.stage("fingerprint"):
+            fingerprint_library(self.library, max_workers=max_workers)
+            return FingerprintIndex(self.library.fingerprints()).duplicates()
+
+    def dedupe_downloads(self, jobs):
+        """
+        Once the library is fingerprinted (see find_duplicates), a new
+        download that is the same recording as a song we already hold
+        under another name is removed again and its track ID is set on
+        the existing file, so the next diff matches it by ID.
+        Returns {downloaded filename: existing path}.
+        """
+        new = [job for job in jobs if job.status == "done"]
+        if not new or not self.library.has_fingerprints():
+            return {}
+        from fingerprint import FingerprintIndex, fingerprint_file
+
+        index = FingerprintIndex(self.library.fingerprints())
+        duplicates = {}
+        for job in new:
+            blob = fingerprint_file(job.path)
+            existing = index.query(blob)
+            if existing is None:
+                self.library.set_fingerprints([(job.filename, blob)])
+                continue
+            os.remove(job.path)
+            job.status, job.path = "duplicate", Path(self.library.root) / existing
+            if job.track_id:
+                self.library.set_spotify_id(existing, job.track_id)
+            duplicates[job.filename] = existing
+
+        if duplicates:
+            self.library.scan()
+        return duplicates
+
+    def resume_syncs(self, resolve_url):
+        """Finish the syncs an earlier (crashed) run left in the journal"""
+        journal = self.get_journal()
+        resumed = list(journal.runs)
+        for playlist_id in resumed:
+            self.sync_playlist(None, resolve_url=resolve_url, playlist_id=playlist_id)
+        return resumed
+
+    def get_store(self, max_workers=8):
+        """Track store of the target folder and its download scheduler (created once)"""
+        from downloader import DownloadScheduler
+        from track_store import TrackStore
+
+        with self.lock:
+            if getattr(self, "store", None) is None:
+                self.store = TrackStore(self.target_folder)
+                self.store_scheduler = DownloadScheduler(self.store.store_dir, max_workers=max_workers)
+            return self.store, self.store_scheduler
+
+    def sync_playlists(self, playlists, resolve_url=None, max_workers=8):
+        """
+        Multi-playlist sync through the shared track store. `playlists`
+        maps a playlist (folder) name to its tracks. Every track is
+        downloaded once into the store, also when several playlists hold
+        it or an earlier run already fetched it, and each playlist folder
+        is built from links to the store. Songs the library already holds
+        are linked into the store instead of downloaded. Tracks are keyed
+        by Spotify ID, tracks without one by the hash of their file.
+        """
+        from downloader import DownloadJob
+
+        store, scheduler = self.get_store(max_workers)
+        resolve_url = self.get_resolver(resolve_url)
+        stored = store.keys()
+
+        def store_key(track):
+            return track.get("id") or store.alias(self.song_filename(track))
+
+        # union of all playlists, keyed by Spotify ID or song name
+        wanted = {}
+        for tracks in playlists.values():
+            for track in tracks:
+                track = track.get("track", track)
+                wanted.setdefault(track.get("id") or self.song_filename(track), track)
+        missing = [track for track in wanted.values() if store_key(track) not in stored]
+
+        def added(track, key):
+            stored.add(key)
+            if not track.get("id"):
+                store.set_alias(self.song_filename(track), key)
+
+        # songs we already hold somewhere in the library
+        matches = self.match_songs(missing)
+        missing = []
+        for track, tier, path in matches:
+            if path is None:
+                missing.append(track)
+            else:
+                added(track, store.add(Path(self.library.root) / path, track.get("id"), keep=True))
+
+        jobs, downloads = [], {}
+        for track in missing if resolve_url else []:
+            url = resolve_url(track)
+            if not url:
+                continue
+            # tracks without ID are stored under their hash once downloaded
+            if track.get("id"):
+                filename = store.filename(track["id"])
+            else:
+                filename = "new-" + self.song_filename(track)
+            jobs.append(DownloadJob(url, filename, track_id=track.get("id")))
+            downloads[filename] = track
+        with metrics.stage("download"):
+            scheduler.run(jobs)
+        for job in jobs:
+            if job.status == "failed":
+                resolve_url.invalidate(job.track_id)
+            elif job.status in ("done", "skipped"):
+                added(downloads[job.filename], job.track_id or store.add(job.path))
+
+        # build playlist folders from links
+        links = {}
+        for name, tracks in playlists.items():
+            folder = Path(self.target_folder) / name
+            for track in tracks:
+                track = track.get("track", track)
+                key = store_key(track)
+                if key in stored:
+                    kind = store.link(key, folder / self.song_filename(track))
+                    links[kind] = links.get(kind, 0) + 1
+
+        return jobs, links
+
+    def edit_song_metadata(self, matches=None, max_workers=None):
+        """
+        Write the Spotify metadata into the local files. `matches` are
+        (track, tier, path) as produced by get_songs_list (self.matches
+        by default). Files already carrying the right tags are skipped.
+        """
+        from collections import Counter
+
+        if matches is None:
+            matches = self.matches
+        songs = [(track, path) for track, tier, path in matches if path]
+        return Counter(self.tag_songs(songs, max_workers=max_workers))
+
+    def tag_songs(self, songs, max_workers=None):
+        """Tag (track, path) pairs, returns the result of each song"""
+        from metadata_tagger import expected_tags, tag_results
+
+        folder = getattr(self, "target_folder", Path("."))
+        items = [(str(Path(folder) / path), expected_tags(track)) for track, path in songs]
+        if not items:
+            return []
+        with metrics.stage("tagging"):
+            return tag_results(items, max_workers=max_workers)
 
 class Tester():
     def __init__(self):
         # initialize all three classes
         self.mdownload = MusicDownloader(test=True)
-        self.api = SpotifyAPI() 
-        self.oauth = SpotifyOAuth(test=True)
+        self._api = None
+        self._oauth = None
+
+    # API objects are only built by the tests that need them
+    @property
+    def api(self):
+        if self._api is None:
+            from auth_api import SpotifyAPI
+            self._api = SpotifyAPI()
+        return self._api
+
+    @property
+    def oauth(self):
+        if self._oauth is None:
+            from auth_api import SpotifyOAuth
+            self._oauth = SpotifyOAuth(test=True)
+        return self._oauth
 
     def setup(self):
         """Test if initial setup is done correctly"""
@@ -145,6 +639,8 @@ class Tester():
 
     def authorize(self):
         
+        from dotenv import load_dotenv
+
         # create enviorment file 
         load_dotenv(".env")
         client_id = os.getenv("SPOTIFY_CLIENT_ID")
@@ -197,16 +693,256 @@ class Tester():
         return 0
 
     def get_local_songs(self):
-        pass
+        """Test local library index"""
+        print("Begin local songs testing...\n")
 
-    def get_spotify_playlist(self):
-        pass
+        # create dummy library
+        prog_dir = Path.cwd()
+        dummy_dir = Path("dummy_library")
+        (dummy_dir / "sub").mkdir(parents=True, exist_ok=True)
+        for name in ["Mr. Brightside.mp3", "sub/The Killers - Human.flac", "notes.txt"]:
+            (dummy_dir / name).touch()
+
+        self.mdownload.target_folder = dummy_dir
+        library = self.mdownload.get_local_songs()
+        if len(library) == 2 and library.lookup("mr brightside") and library.lookup("Human", "The Killers"):
+            print("Local songs indexed correctly!")
+        else:
+            print("Local songs not indexed correctly...")
+            return 1
+
+        # second scan should not list unchanged directories
+        if library.scan() == 0:
+            print("Unchanged directories skipped!")
+        else:
+            print("Unchanged directories were rescanned...")
+            return 2
+
+        # clean-up dummy library
+        library.close()
+        self.mdownload.library = None
+        os.chdir(prog_dir)
+        for path in sorted(dummy_dir.rglob("*"), reverse=True):
+            path.rmdir() if path.is_dir() else path.unlink()
+        dummy_dir.rmdir()
+
+        print("\nLocal songs test PASSED!")
+        return 0
+
+    def get_spotify_playlist(self, playlist_id=None):
+        """Test paginated playlist fetch"""
+        print("Begin playlist testing...\n")
+
+        if playlist_id is None:
+            playlist_id = input("Enter a Spotify playlist ID: ").strip()
+
+        # stream tracks and count them
+        count = 0
+        for item in self.api.get_playlist(playlist_id):
+            count += 1
+        
+        if count:
+            print(f"{count} tracks retrieved!")
+        else:
+            print("No tracks retrieved...")
+            return 1
+
+        print("\nPlaylist test PASSED!")
+        return 0
 
     def download_songs(self):
-        pass
+        """Test concurrent downloads and .part resume against a local server"""
+        from downloader import DownloadJob
+        from fake_server import FileHandler, start_server
+        print("Begin download testing...\n")
+
+        # serve dummy songs from a local server
+        files = {f"/song{i}.mp3": os.urandom(200_000 + i) for i in range(20)}
+        server = start_server(FileHandler, files=files)
+        self.mdownload.target_folder = Path("dummy_downloads")
+        self.mdownload.target_folder.mkdir(exist_ok=True)
+
+        # simulate an interrupted download
+        (self.mdownload.target_folder / "song0.mp3.part").write_bytes(files["/song0.mp3"][:1000])
+
+        jobs = [DownloadJob(server.base_url + name, name[1:]) for name in files]
+        self.mdownload.download_songs(jobs)
+        server.shutdown()
+
+        failed = [job for job in jobs if job.status != "done"]
+        if failed:
+            print(f"Downloads failed: {failed}")
+            return 1
+        print(f"{len(jobs)} songs downloaded!")
+
+        # check content (including the resumed file)
+        for name, data in files.items():
+            if (self.mdownload.target_folder / name[1:]).read_bytes() != data:
+                print(f"{name[1:]} content is wrong...")
+                return 2
+        print("Partial download resumed correctly!")
+
+        # clean-up dummy downloads
+        for path in self.mdownload.target_folder.iterdir():
+            path.unlink()
+        self.mdownload.target_folder.rmdir()
+
+        print("\nDownload test PASSED!")
+        return 0
 
     def edit_metadata(self):
-        pass
+        """Test batch tagging (needs mutagen)"""
+        print("Begin metadata testing...\n")
+        try:
+            import mutagen
+        except ImportError:
+            print("mutagen is not installed (pip install mutagen)...")
+            return 1
+
+        # dummy untagged songs
+        dummy_dir = Path("dummy_tags")
+        dummy_dir.mkdir(exist_ok=True)
+        tracks = []
+        for i in range(40):
+            (dummy_dir / f"song{i}.mp3").write_bytes(b"\x00" * 1000)
+            track = {"name": f"Song {i}", "artists": [{"name": "Artist"}], "album": {"name": "Album"},
+                     "track_number": i + 1, "external_ids": {"isrc": f"USX{i:09d}"}}
+            tracks.append((track, "exact", f"song{i}.mp3"))
+        self.mdownload.target_folder = dummy_dir
+
+        results = self.mdownload.edit_song_metadata(tracks)
+        if results["tagged"] == len(tracks):
+            print(f"{results['tagged']} songs tagged!")
+        else:
+            print(f"Tagging failed: {dict(results)}")
+            return 2
+
+        # second run should not touch the files
+        results = self.mdownload.edit_song_metadata(tracks)
+        if results["skipped"] == len(tracks):
+            print("Correctly tagged songs skipped!")
+        else:
+            print(f"Tagged songs were rewritten: {dict(results)}")
+            return 3
+
+        # clean-up dummy songs
+        for path in dummy_dir.iterdir():
+            path.unlink()
+        dummy_dir.rmdir()
+
+        print("\nMetadata test PASSED!")
+        return 0
+
+    def playlist_cache(self):
+        """Test playlist versions stored as snapshot deltas (emptied and refilled) and oversized ISRCs"""
+        import tempfile
+        from fake_server import fake_track
+        from playlist_cache import PlaylistCache, slim_track
+        from track_model import TrackList
+        print("Begin playlist cache testing...\n")
+
+        tracks = [slim_track(fake_track(i)) for i in range(100)]
+        with tempfile.TemporaryDirectory() as folder:
+            cache = PlaylistCache(folder)
+
+            # an empty version must not restart the file numbering
+            versions = [("full", tracks), ("one removed", tracks[1:]), ("emptied", []),
+                        ("refilled", tracks), ("one removed again", tracks[1:])]
+            for number, (name, version) in enumerate(versions):
+                cache.put("fake", f"snapshot{number}", None, version)
+                cached = cache.get("fake")
+                if cached is None or cached["snapshot_id"] != f"snapshot{number}" or cached["tracks"] != version:
+                    print(f"Playlist {name}: wrong version cached")
+                    return 1
+                print(f"Playlist {name}: {len(version)} tracks cached")
+
+            # hyphenated ISRCs are normalized, invalid ones dropped (the track is kept)
+            oversized = [dict(tracks[0], external_ids={"isrc": "US-RC1-76-07839"}),
+                         dict(tracks[1], external_ids={"isrc": "USFAKE00000001"})]
+            expected = ["USRC17607839", None]
+            for name, version in (("slim tracks", oversized), ("track list", TrackList.from_items(oversized))):
+                cache.put("oversized", name, None, version)
+                isrcs = [track["external_ids"]["isrc"] for track in cache.get("oversized")["tracks"]]
+                if isrcs != expected:
+                    print(f"Oversized ISRCs of {name} stored as {isrcs}")
+                    return 2
+            print("Oversized ISRCs normalized or dropped")
+
+        print("\nPlaylist cache test PASSED!")
+        return 0
+
+    def work_queue(self):
+        """Test a shared sync plan worked by several processes, one of them killed"""
+        import tempfile
+        import multiprocessing
+        from functools import partial
+        from fake_server import fake_file_url, fake_track, start_fake_spotify
+        from work_queue import WorkQueue, DONE, FAILED
+        print("Begin work queue testing...\n")
+
+        server = start_fake_spotify(file_size=64 * 1024, file_latency=0.05)
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            self.mdownload.target_folder = folder / "music"
+            self.mdownload.target_folder.mkdir()
+
+            # short lease so the killed worker's items come back quickly
+            queue = WorkQueue(folder / "queue.db", lease=2.0)
+            planned = self.mdownload.plan_sync([fake_track(i) for i in range(120)], queue, "fake")
+            print(f"{planned} songs planned")
+
+            options = {"queue_options": {"lease": 2.0}, "source_cache": folder / "sources.db",
+                       "batch": 8, "max_workers": 4, "poll": 0.2}
+            context = multiprocessing.get_context("spawn")
+            workers = [context.Process(target=sync_worker, kwargs=options, args=(
+                           folder / "queue.db", self.mdownload.target_folder,
+                           partial(fake_file_url, server.base_url)))
+                       for _ in range(3)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+
+            # crash one worker in the middle of the sync
+            while queue.counts()[DONE] < 20 and time.perf_counter() - start < 60:
+                time.sleep(0.05)
+            workers[0].kill()
+            for worker in workers[1:]:
+                worker.join(120)
+            seconds = time.perf_counter() - start
+            server.shutdown()
+
+            counts = queue.counts()
+            reclaimed = queue.conn.execute("SELECT COUNT(*) FROM items WHERE attempts > 1").fetchone()[0]
+            files = sorted(path.name for path in self.mdownload.target_folder.iterdir()
+                           if path.suffix == ".mp3")
+            queue.close()
+
+        print(f"{counts[DONE]} songs done in {seconds:.2f}s by 3 workers, "
+              f"{reclaimed} taken over from the killed worker")
+        if counts[DONE] != planned or counts[FAILED] or len(files) != planned:
+            print(f"Sync incomplete: {counts}, {len(files)} files")
+            return 1
+
+        print("\nWork queue test PASSED!")
+        return 0
+
+def sync_worker(queue_path, target_folder, resolve_url, queue_options=None, source_cache=None, **options):
+    """
+    Process entry point of a work_sync worker. `resolve_url` must be
+    picklable, `source_cache` is the path of its own source cache.
+    """
+    from work_queue import WorkQueue
+    from source_cache import CachedResolver, SourceCache
+
+    mdownload = MusicDownloader(test=True)
+    mdownload.target_folder = Path(target_folder)
+    if source_cache:
+        resolve_url = CachedResolver(resolve_url, SourceCache(source_cache))
+    queue = WorkQueue(queue_path, **(queue_options or {}))
+    try:
+        return mdownload.work_sync(queue, resolve_url, **options)
+    finally:
+        queue.close()
 
 def main():
     #  set up parser for arguments 
@@ -217,21 +953,45 @@ def main():
     
     # add arguments 
     parser.add_argument("--test",
-                        choices=["setup", "authent", "authorize", "local_songs",
-                                "get_playlist", "download_songs", "edit_metadata"],
+                        choices=list(TESTS),
                         help="Test program setting (used for development).")
     
     parser.add_argument("--target-folder",
                         help="Set-up destination folder. If folder dosen't exist create it.")
     
-    parser.add_argument("--playlist",
-                        help="Set-up Spotify playlist to get playlists from.")
+    parser.add_argument("--playlist", nargs="+",
+                        help="Set-up Spotify playlist(s) to get playlists from.")
+
+    parser.add_argument("--pipeline", choices=["async"],
+                        help="Sync the playlist as a streaming fetch/match/download/tag pipeline.")
+
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running and sync the playlist whenever it changes.")
+
+    parser.add_argument("--resolver", metavar="MODULE:FUNCTION",
+                        help="Function returning the download URL of a track (for --daemon and --pipeline).")
+
+    parser.add_argument("--find-duplicates", action="store_true",
+                        help="List songs of the target folder that are the same recording (needs NumPy and ffmpeg).")
+
+    parser.add_argument("--metrics", choices=["json"],
+                        help="Print run metrics (stage timers, HTTP, cache, bytes) at the end.")
+
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep the library index current with inotify (with --daemon, Linux only).")
+
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics on this port (with --daemon).")
+
+    parser.add_argument("--profile", nargs="?", const="m_downloader.prof",
+                        help="Run under cProfile and write the stats to this file.")
     
     # extract arguments 
     args = parser.parse_args()
     
     # check if no arguments where given and show usage message
-    if not any([args.test, args.target_folder, args.playlist]):
+    if not any([args.test, args.target_folder, args.playlist, args.daemon, args.pipeline,
+                args.find_duplicates]):
         print("""No arguments were given...
               Intended use:
 
@@ -246,28 +1006,138 @@ def main():
               """)
         sys.exit()
 
-    # set up tester only if on testing mode
-    if args.test:
-        test = Tester()
-
-        # run test depending on argument
-        if args.test == "setup":
-            test.setup()
-        elif args.test == "authent":
-            test.authenticate()
-        elif args.test == "authorize":
-            test.authorize()
-        elif args.test == "local_songs":
-            test.get_local_songs()
-        elif args.test == "get_playlist":
-            test.get_spotify_playlist()
-        elif args.test == "download_songs":
-            test.download_songs()
-        elif args.test == "edit_metadata":
-            test.edit_metadata()
-
-        # exit program after running test
-        return
+    # optional profiling of the whole run
+    if args.profile:
+        import cProfile
+        # runs change the working directory, keep the path absolute
+        args.profile = os.path.abspath(args.profile)
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {args.profile}")
+    else:
+        run(args)
+
+    if args.metrics == "json":
+        print(metrics.to_json())
+
+def run_tests(args):
+    """Run one development test"""
+    test = Tester()
+    return getattr(test, TESTS[args.test])()
+
+def load_resolver(spec):
+    """
+    resolve_url(track) function named "module:function", None without
+    a spec (syncs then only report the missing songs).
+    """
+    if not spec:
+        print("No --resolver given, missing songs are listed but not downloaded")
+        return None
+    import importlib
+
+    module, _, name = spec.partition(":")
+    if not name:
+        sys.exit(f"--resolver must look like module:function, got {spec!r}")
+    # resolver modules next to where the program was started
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module), name)
+
+def run_pipeline(args):
+    """Sync playlists with the streaming pipeline"""
+    import asyncio
+    from auth_api import SpotifyAPI
+    from batch_loader import Enricher
+    from pipeline import AsyncPipeline
+
+    resolve_url = load_resolver(args.resolver)
+    mdownload = MusicDownloader(dest_file=args.target_folder, playlists=args.playlist)
+    api = SpotifyAPI()
+    # lookups are cached across playlists
+    enricher = Enricher(api)
+    # finish syncs a crashed run left in the journal
+    if resolve_url:
+        mdownload.resume_syncs(resolve_url)
+    for playlist_id in mdownload.state["playlists"]:
+        pipeline = AsyncPipeline(mdownload, api, resolve_url=resolve_url, enricher=enricher)
+        stats = asyncio.run(pipeline.run(playlist_id))
+        print(json.dumps({playlist_id: stats}, indent=2))
+
+def run_daemon(args):
+    """Long running sync daemon"""
+    from auth_api import SpotifyOAuth, SpotifyAPI
+    from smart_schedauler import SmartSchedualer
+
+    resolve_url = load_resolver(args.resolver)
+    mdownload = MusicDownloader(dest_file=args.target_folder, playlists=args.playlist)
+    # one cached resolver for every sync
+    resolve_url = mdownload.get_resolver(resolve_url)
+    api = SpotifyAPI()
+    api.auth = SpotifyOAuth()
+    api.auth.start_auto_refresh()
+    if not (args.watch and mdownload.watch_library()):
+        mdownload.get_local_songs()
+    # finish syncs a crashed run left in the journal
+    if resolve_url:
+        mdownload.resume_syncs(resolve_url)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    playlists = mdownload.state["playlists"]
+    if len(playlists) > 1:
+        # several playlists share one track store, created before the
+        # scheduler runs their syncs concurrently
+        mdownload.get_store()
+        sync = lambda playlist_id, tracks: mdownload.sync_playlists(
+            {playlist_id: tracks}, resolve_url=resolve_url)
+    else:
+        sync = lambda playlist_id, tracks: mdownload.sync_playlist(
+            tracks, resolve_url=resolve_url, playlist_id=playlist_id)
+
+    scheduler = SmartSchedualer(api, sync, playlists)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+def run_find_duplicates(args):
+    """Print groups of duplicate recordings in the library"""
+    mdownload = MusicDownloader(dest_file=args.target_folder, playlists=args.playlist)
+    groups = mdownload.find_duplicates()
+    for group in groups:
+        print("\n".join(group) + "\n")
+    print(f"{len(groups)} duplicate groups found")
+
+# --test option -> Tester method
+TESTS = {
+    "setup": "setup",
+    "authent": "authentificate",
+    "authorize": "authorize",
+    "local_songs": "get_local_songs",
+    "get_playlist": "get_spotify_playlist",
+    "download_songs": "download_songs",
+    "edit_metadata": "edit_metadata",
+    "playlist_cache": "playlist_cache",
+    "work_queue": "work_queue",
+}
+
+# command line modes: the first one whose argument is given runs
+MODES = [
+    ("test", run_tests),
+    ("pipeline", run_pipeline),
+    ("daemon", run_daemon),
+    ("find_duplicates", run_find_duplicates),
+]
+
+def run(args):
+    """Run the mode selected on the command line"""
+    for option, mode in MODES:
+        if getattr(args, option):
+            return mode(args)
         
 
 if __name__ == "__main__":
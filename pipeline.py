@@ -0,0 +1,196 @@
+import time
+import asyncio
+from downloader import DownloadJob, DownloadScheduler
+from song_matcher import SongMatcher
+from metadata_tagger import expected_tags, tag_file
+from sync_journal import PLANNED, DOWNLOADING, DONE as DOWNLOADED, TAGGED, FAILED
+
+# marks the end of a stage's output
+DONE = object()
+
+class AsyncPipeline:
+    def __init__(self, mdownload, api, resolve_url=None, download_workers=8, queue_size=256,
+                 enricher=None):
+        """
+        Streaming sync: fetch -> match -> download -> tag, connected by
+        bounded asyncio queues so a slow stage holds back the ones before
+        it and memory stays flat. The first song is downloaded while
+        later playlist pages are still being fetched. With an `enricher`
+        (batch_loader.Enricher) the lookups of every missing track are
+        queued when it is matched and batched across all tracks in flight.
+
+        Tracks come from the playlist cache (SpotifyAPI.get_playlist_tracks),
+        an unchanged playlist is not fetched again and a changed one is
+        only committed to the cache once the run finished. With a resolver
+        every missing song is recorded in the sync journal like
+        MusicDownloader.sync_playlist does, so a crashed run is finished
+        by MusicDownloader.resume_syncs.
+        """
+        self.mdownload = mdownload
+        self.api = api
+        self.resolve_url = mdownload.get_resolver(resolve_url)
+        self.enricher = enricher
+        self.journal = mdownload.get_journal() if self.resolve_url else None
+        self.playlist_id = None
+        # key -> file name of the songs planned in this run
+        self.planned = {}
+        self.used = set()
+        self.lookups = {}
+        self.download_workers = download_workers
+        self.queue_size = queue_size
+        self.stats = {"fetched": 0, "matched": 0, "missing": 0, "downloaded": 0,
+                      "tagged": 0, "failed": 0}
+        self.first_track_at = None
+        self.cancelled = False
+
+    async def fetch(self, playlist_id, out):
+        """Stream playlist tracks from a worker thread into the queue"""
+        loop = asyncio.get_running_loop()
+
+        def put(item):
+            # blocks the thread (not the loop) while the queue is full
+            future = asyncio.run_coroutine_threadsafe(out.put(item), loop)
+            while not self.cancelled:
+                try:
+                    return future.result(timeout=1)
+                except TimeoutError:
+                    pass
+            future.cancel()
+            raise Exception("Pipeline cancelled")
+
+        def put_item(item):
+            if item.get("track"):
+                put(item["track"])
+
+        def produce():
+            # a changed playlist is streamed as its pages arrive
+            tracks, changed = self.api.get_playlist_tracks(playlist_id, commit=False, on_item=put_item)
+            if not changed:
+                for track in tracks:
+                    put(track.to_dict())
+            put(DONE)
+
+        await asyncio.to_thread(produce)
+
+    def record(self, entry, state, **fields):
+        if self.journal:
+            self.journal.record(self.playlist_id, entry["key"], state, **fields)
+
+    async def match(self, inp, out):
+        """Split tracks into local matches and songs to download"""
+        # pick up what changed locally since the last run (cheap rescan)
+        await asyncio.to_thread(self.mdownload.get_local_songs)
+        matcher = SongMatcher(self.mdownload.library.songs())
+
+        while (track := await inp.get()) is not DONE:
+            self.stats["fetched"] += 1
+            tier, path = matcher.match(track)
+            entry = None
+            if tier is None:
+                if self.resolve_url:
+                    planned = len(self.planned)
+                    entry = self.mdownload.plan_entry(track, self.planned, self.used)
+                    if len(self.planned) == planned:
+                        # listed twice, downloaded once
+                        continue
+                    self.record(entry, PLANNED, track=entry["track"], filename=entry["filename"])
+                self.stats["missing"] += 1
+                if self.enricher and track.get("id"):
+                    self.lookups[track["id"]] = self.enricher.prefetch(track)
+            else:
+                self.stats["matched"] += 1
+            await out.put((track, path, entry))
+        # no more lookups coming, don't wait for the batch timer
+        if self.enricher:
+            self.enricher.flush()
+        for _ in range(self.download_workers):
+            await out.put(DONE)
+
+    async def download(self, scheduler, inp, out):
+        """Download worker: missing songs are resolved, downloaded and passed on"""
+        while (item := await inp.get()) is not DONE:
+            track, path, entry = item
+            if path is None and self.resolve_url:
+                url = await asyncio.to_thread(self.resolve_url, track)
+                if url is None:
+                    self.record(entry, FAILED, error="no source")
+                    self.stats["failed"] += 1
+                    continue
+                self.record(entry, DOWNLOADING, url=url)
+                job = DownloadJob(url, entry["filename"], track_id=track.get("id"))
+                try:
+                    await asyncio.to_thread(scheduler.download, job)
+                except Exception as e:
+                    print(f"Download of {job.filename} failed: {e}")
+                    self.resolve_url.invalidate(job.track_id)
+                    self.record(entry, FAILED, error=str(e))
+                    self.stats["failed"] += 1
+                    continue
+                self.record(entry, DOWNLOADED)
+                self.stats["downloaded"] += 1
+                if self.first_track_at is None:
+                    self.first_track_at = time.perf_counter()
+                await out.put((track, job.filename, entry))
+        await out.put(DONE)
+
+    async def tag(self, inp):
+        """Tag new downloads, runs until every download worker finished"""
+        finished = 0
+        while finished < self.download_workers:
+            item = await inp.get()
+            if item is DONE:
+                finished += 1
+                continue
+            track, path, entry = item
+            if self.enricher:
+                await asyncio.to_thread(self.enricher.enrich_track, track,
+                                        self.lookups.pop(track.get("id"), None))
+            result = await asyncio.to_thread(
+                tag_file, str(self.mdownload.target_folder / path), expected_tags(track))
+            if result == "failed":
+                self.record(entry, FAILED, error="tagging")
+            else:
+                self.record(entry, TAGGED)
+            if result == "tagged":
+                self.stats["tagged"] += 1
+
+    async def run(self, playlist_id):
+        """Run the pipeline for one playlist and return the stats"""
+        start = time.perf_counter()
+        self.playlist_id = playlist_id
+        if self.journal:
+            self.journal.start(playlist_id)
+        tracks = asyncio.Queue(self.queue_size)
+        matched = asyncio.Queue(self.queue_size)
+        downloaded = asyncio.Queue(self.queue_size)
+        scheduler = DownloadScheduler(self.mdownload.target_folder)
+        scheduler.target_folder.mkdir(parents=True, exist_ok=True)
+
+        # a single tagger consumes every download worker's DONE
+        tasks = [
+            asyncio.create_task(self.fetch(playlist_id, tracks)),
+            asyncio.create_task(self.match(tracks, matched)),
+            *[asyncio.create_task(self.download(scheduler, matched, downloaded))
+              for _ in range(self.download_workers)],
+            asyncio.create_task(self.tag(downloaded)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other stages (and the fetch thread) on failure
+            self.cancelled = True
+            for task in tasks:
+                task.cancel()
+            raise
+
+        # synced: the playlist version goes to the cache, the run is complete
+        self.api.commit_playlist_tracks(playlist_id)
+        if self.journal:
+            self.journal.end(playlist_id)
+
+        elapsed = time.perf_counter() - start
+        self.stats["seconds"] = round(elapsed, 3)
+        self.stats["time_to_first_track"] = (round(self.first_track_at - start, 3)
+                                             if self.first_track_at else None)
+        self.stats["tracks_per_sec"] = round(self.stats["fetched"] / elapsed, 1) if elapsed else None
+        return self.stats
@@ -0,0 +1,95 @@
+import zlib
+from pathlib import Path
+from snapshot import Snapshot, TRACK_COLUMNS, track_row
+from track_model import TrackList
+
+CACHE_DIR = Path.home() / ".cache" / "music_downloader" / "playlists"
+
+def slim_track(item):
+    """Keep only the track fields we use from a playlist item"""
+    track = item.get("track") or {}
+    return {
+        "id": track.get("id"),
+        "name": track.get("name"),
+        "artists": [{"id": a.get("id"), "name": a.get("name")} for a in track.get("artists") or []],
+        "album": {"id": (track.get("album") or {}).get("id"), "name": (track.get("album") or {}).get("name")},
+        "external_ids": {"isrc": (track.get("external_ids") or {}).get("isrc")},
+        "track_number": track.get("track_number"),
+        "duration_ms": track.get("duration_ms"),
+    }
+
+
+class PlaylistCache:
+    def __init__(self, cache_dir=CACHE_DIR):
+        """
+        Persistent cache of playlists: a columnar snapshot (see snapshot)
+        per playlist version holding the tracks, its snapshot_id and the
+        ETag of its metadata response. A new version is written as a
+        delta of the previous one, which is kept, so the last change can
+        be computed on the ID columns without building any tracks.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, playlist_id, generation):
+        return self.cache_dir / f"{playlist_id}.{generation:06d}.snap"
+
+    def files(self, playlist_id):
+        """Snapshot files of a playlist, oldest first"""
+        return sorted(self.cache_dir.glob(f"{playlist_id}.*.snap"))
+
+    def snapshot(self, playlist_id, previous=False):
+        """Latest (or the one before) Snapshot of a playlist or None"""
+        files = self.files(playlist_id)
+        index = -2 if previous else -1
+        if len(files) < -index:
+            return None
+        try:
+            return Snapshot.load(files[index])
+        except (OSError, ValueError, IndexError, zlib.error):
+            # damaged file or delta chain: a cache miss
+            return None
+
+    def get(self, playlist_id):
+        """Cached entry {snapshot_id, etag, tracks} or None"""
+        snapshot = self.snapshot(playlist_id)
+        if snapshot is None:
+            return None
+        return {**snapshot.meta, "tracks": snapshot.tracks()}
+
+    def put(self, playlist_id, snapshot_id, etag, tracks, **meta):
+        """
+        Store a new version (a TrackList or slim track dicts), as a delta
+        of the previous one if worth it. Extra `meta` fields are kept with
+        the snapshot_id and ETag.
+        """
+        # numbered after the newest file (an empty or unreadable snapshot
+        # must not restart the numbering and overwrite its base)
+        files = self.files(playlist_id)
+        generation = int(files[-1].name.split(".")[-2]) + 1 if files else 0
+        previous = self.snapshot(playlist_id)
+        path = self.path(playlist_id, generation)
+        rows = tracks.rows() if isinstance(tracks, TrackList) else (track_row(track) for track in tracks)
+        Snapshot.write(path, TRACK_COLUMNS, rows, meta={**meta, "snapshot_id": snapshot_id, "etag": etag},
+                       base=previous)
+
+        # keep the files of the new and the previous version only
+        live = set(Snapshot.chain_files(path))
+        if previous is not None:
+            live.update(Snapshot.chain_files(previous.path))
+        for old in self.files(playlist_id):
+            if old.name not in live:
+                old.unlink(missing_ok=True)
+        return {**meta, "snapshot_id": snapshot_id, "etag": etag, "tracks": tracks}
+
+    def changes(self, playlist_id):
+        """
+        (added, removed) track IDs (bytes) between the last two stored
+        versions, None if the playlist is not cached.
+        """
+        snapshot = self.snapshot(playlist_id)
+        if snapshot is None:
+            return None
+        return snapshot.changes(self.snapshot(playlist_id, previous=True))
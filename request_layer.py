@@ -0,0 +1,122 @@
+import time
+import random
+import threading
+import urllib.parse as url_parse
+from metrics import metrics
+
+class TokenBucket:
+    def __init__(self, rate=20.0, burst=20):
+        """Client-side rate limit: `rate` requests per second, `burst` at once"""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take one token, sleeping until it is available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # reserve the token now and sleep outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    def __init__(self, initial=4, minimum=1, maximum=32):
+        """
+        Concurrency limit adjusted AIMD-style: +1 per limit healthy
+        responses (about +1 per round trip), halved on throttling.
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestLayer:
+    def __init__(self, session, rate=20.0, burst=20, initial_concurrency=4,
+                 max_concurrency=32, max_retries=5):
+        """
+        Shared request layer: token bucket, adaptive concurrency and
+        retries honoring Retry-After on 429 (backoff on 5xx).
+        """
+        self.session = session
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveLimit(initial_concurrency, maximum=max_concurrency)
+        self.max_retries = max_retries
+
+        # a 429 pauses every request until this time
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def wait_if_blocked(self):
+        """Sleep while the server told us to back off"""
+        wait = self.blocked_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        """Pause all requests for `seconds`"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def request(self, method, url, **kwargs):
+        """Send request, retrying on 429 and 5xx. Other statuses are returned as is."""
+        for attempt in range(self.max_retries + 1):
+            self.wait_if_blocked()
+            self.bucket.take()
+            self.concurrency.acquire()
+            throttled = False
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                throttled = response.status_code == 429
+            finally:
+                self.concurrency.release(throttled=throttled)
+
+            host = url_parse.urlsplit(url).netloc
+            metrics.inc("http_requests_total", host=host, status=response.status_code)
+            metrics.observe("http_request_seconds", time.perf_counter() - start, host=host)
+
+            if response.status_code == 429:
+                self.throttled += 1
+                try:
+                    retry_after = float(response.headers.get("Retry-After", 1))
+                except ValueError:
+                    retry_after = 1.0
+                self.block(retry_after)
+            elif response.status_code >= 500:
+                # exponential backoff with jitter
+                time.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1))
+            else:
+                return response
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
@@ -1,6 +1,114 @@
-import os
-from datetime import datetime, timedelta
+import time
+import heapq
+import random
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 class SmartSchedualer():
-    def __init__():
-        pass
\ No newline at end of file
+    def __init__(self, api, sync, playlists, min_interval=60, max_interval=6 * 3600,
+                 max_jobs=2, jitter=0.1):
+        """
+        Long running sync daemon. Every playlist is polled on its own
+        interval: halved when the playlist changed, doubled when it
+        didn't (between min_interval and max_interval seconds). Only
+        playlists whose snapshot changed are handed to `sync`, which is
+        called as sync(playlist_id, tracks).
+        """
+        self.api = api
+        self.sync = sync
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_jobs = max_jobs
+        self.jitter = jitter
+
+        self.intervals = {playlist_id: min_interval for playlist_id in playlists}
+        self.last_run = {}
+        # (due time, playlist id) min-heap, all playlists are due now
+        self.queue = [(time.monotonic(), playlist_id) for playlist_id in playlists]
+        heapq.heapify(self.queue)
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def add_playlist(self, playlist_id):
+        """Start polling another playlist"""
+        with self.lock:
+            if playlist_id not in self.intervals:
+                self.intervals[playlist_id] = self.min_interval
+                heapq.heappush(self.queue, (time.monotonic(), playlist_id))
+        self.wakeup.set()
+
+    def reschedule(self, playlist_id, changed):
+        """Adapt polling interval and push the playlist back in the queue"""
+        with self.lock:
+            interval = self.intervals[playlist_id]
+            if changed:
+                interval = max(self.min_interval, interval / 2)
+            else:
+                interval = min(self.max_interval, interval * 2)
+            self.intervals[playlist_id] = interval
+
+            # jitter spreads playlists so they don't all poll together
+            delay = interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            heapq.heappush(self.queue, (time.monotonic() + delay, playlist_id))
+        self.wakeup.set()
+
+    def poll(self, playlist_id):
+        """Check one playlist and sync it if its snapshot changed"""
+        changed = False
+        try:
+            # the new version is only cached once it is synced, a failed
+            # or interrupted sync is retried on the next poll
+            tracks, changed = self.api.get_playlist_tracks(playlist_id, commit=False)
+            if changed:
+                self.sync(playlist_id, tracks)
+                self.api.commit_playlist_tracks(playlist_id)
+            self.last_run[playlist_id] = (datetime.now(), changed, None)
+        except Exception as e:
+            self.last_run[playlist_id] = (datetime.now(), changed, str(e))
+            print(f"Sync of playlist {playlist_id} failed: {e}")
+        finally:
+            self.reschedule(playlist_id, changed)
+
+    def next_due(self):
+        """Pop next due playlist or return seconds until one is due"""
+        with self.lock:
+            if not self.queue:
+                return None, None
+            due, playlist_id = self.queue[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self.queue)
+            return playlist_id, 0
+
+    def run(self):
+        """Run until stop() is called"""
+        jobs = threading.BoundedSemaphore(self.max_jobs)
+
+        def job(playlist_id):
+            try:
+                self.poll(playlist_id)
+            finally:
+                jobs.release()
+
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while not self.stopped.is_set():
+                playlist_id, wait = self.next_due()
+                if playlist_id is None:
+                    # sleep until next playlist is due or something changed
+                    self.wakeup.wait(wait)
+                    self.wakeup.clear()
+                    continue
+
+                # cap concurrent jobs, wait for a free slot
+                while not jobs.acquire(timeout=1):
+                    if self.stopped.is_set():
+                        return
+                executor.submit(job, playlist_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import tempfile
+from pathlib import Path
+
+# file layout (little endian, sections aligned to 8 bytes):
+#
+#   magic (8 bytes) | header length (uint32) | JSON header | sections
+#
+# a full snapshot holds the string table (uint32 offsets + UTF-8 blob) and
+# one fixed-width array per column, all memory-mapped on load. A delta
+# snapshot names its base file and holds (zlib compressed) the row sources
+# and the rows and strings that are new.
+FULL_MAGIC = b"MDSNAP1F"
+DELTA_MAGIC = b"MDSNAP1D"
+ALIGN = 8
+
+# column kinds: fixed-width IDs and ints, "str" is an index into the
+# string table (every distinct string is stored once)
+COLUMN_TYPES = {"id": "S22", "isrc": "S12", "str": "<u4", "u16": "<u2", "u32": "<u4"}
+
+# kinds of fixed-width columns that already warned about a dropped value
+dropped_kinds = set()
+
+# slim track (playlist_cache.slim_track) as columns, multiple artists are
+# joined with the unit separator
+TRACK_COLUMNS = [
+    ("id", "id"), ("name", "str"), ("artists", "str"), ("artist_ids", "str"),
+    ("album_id", "id"), ("album", "str"), ("isrc", "isrc"),
+    ("track_number", "u16"), ("duration_ms", "u32"),
+]
+SEPARATOR = "\x1f"
+
+# a delta chain is rewritten as a full snapshot when it gets this long or
+# the new rows are more than this fraction of the snapshot
+MAX_CHAIN = 8
+MAX_DELTA_ROWS = 0.25
+
+def track_row(track):
+    """Slim track -> row of TRACK_COLUMNS values"""
+    artists = track.get("artists") or []
+    album = track.get("album") or {}
+    if len(artists) == 1:
+        names, ids = artists[0].get("name") or "", artists[0].get("id") or ""
+    else:
+        names = SEPARATOR.join(artist.get("name") or "" for artist in artists)
+        ids = SEPARATOR.join(artist.get("id") or "" for artist in artists)
+    return (
+        track.get("id") or "",
+        track.get("name") or "",
+        names,
+        ids,
+        album.get("id") or "",
+        album.get("name") or "",
+        (track.get("external_ids") or {}).get("isrc") or "",
+        track.get("track_number") or 0,
+        track.get("duration_ms") or 0,
+    )
+
+def row_track(row):
+    """Row of TRACK_COLUMNS values -> slim track"""
+    track_id, name, artists, artist_ids, album_id, album, isrc, track_number, duration_ms = row
+    names = artists.split(SEPARATOR) if artists else []
+    ids = artist_ids.split(SEPARATOR) if artist_ids else [""] * len(names)
+    return {
+        "id": track_id or None,
+        "name": name or None,
+        "artists": [{"id": artist_id or None, "name": artist_name or None}
+                    for artist_id, artist_name in zip(ids, names)],
+        "album": {"id": album_id or None, "name": album or None},
+        "external_ids": {"isrc": isrc or None},
+        "track_number": track_number or None,
+        "duration_ms": duration_ms or None,
+    }
+
+def fit_value(kind, value):
+    """
+    Encoded value for a fixed-width id or isrc column. ISRCs are
+    normalized first ("us-rc1-76-07839" -> "USRC17607839"), a value that
+    still does not fit is dropped (stored empty) with a warning, the rest
+    of its row is kept.
+    """
+    data = value.encode()
+    width = int(COLUMN_TYPES[kind][1:])
+    if len(data) <= width:
+        return data
+    if kind == "isrc":
+        data = value.replace("-", "").replace(" ", "").upper().encode()
+        if len(data) <= width:
+            return data
+    if kind not in dropped_kinds:
+        dropped_kinds.add(kind)
+        print(f"Warning: dropping {kind} values longer than {width} bytes (e.g. {value!r})",
+              file=sys.stderr)
+    return b""
+
+def padding(size):
+    return -size % ALIGN
+
+def encode_column(kind, values, strings):
+    """Column values -> fixed-width array, new strings are added to `strings`"""
+    import numpy as np
+
+    if kind == "str":
+        for value in dict.fromkeys(values):
+            if value not in strings:
+                strings[value] = len(strings)
+        return np.fromiter((strings[value] for value in values), dtype="<u4", count=len(values))
+    if kind in ("id", "isrc"):
+        encoded = [value.encode() for value in values]
+        if encoded and max(map(len, encoded)) > int(COLUMN_TYPES[kind][1:]):
+            encoded = [fit_value(kind, value) for value in values]
+        return np.array(encoded, dtype=COLUMN_TYPES[kind])
+    return np.array(values, dtype=COLUMN_TYPES[kind])
+
+
+class Snapshot:
+    def __init__(self, columns, count, strings, offsets, arrays, meta=None, path=None, chain=1):
+        """
+        Columnar table of rows. `arrays` holds one fixed-width NumPy array
+        per column (memory-mapped for full snapshots), strings are only
+        decoded when a row is materialized. Use Snapshot.load / write.
+        """
+        self.columns = columns
+        self.count = count
+        self.blob = strings
+        self.offsets = offsets
+        self.arrays = arrays
+        self.meta = meta or {}
+        self.path = path
+        # number of files read to build this snapshot (1 = full)
+        self.chain = chain
+        self._strings = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    @property
+    def ids(self):
+        return self.arrays["id"]
+
+    def string_list(self):
+        """All interned strings, decoded once"""
+        if self._strings is None:
+            blob = bytes(self.blob)
+            offsets = self.offsets.tolist()
+            self._strings = [blob[start:end].decode() for start, end in zip(offsets, offsets[1:])]
+        return self._strings
+
+    def rows(self):
+        """Rows as tuples of Python values, in order"""
+        strings = self.string_list()
+        columns = []
+        for name, kind in self.columns:
+            values = self.arrays[name].tolist()
+            if kind == "str":
+                values = [strings[index] for index in values]
+            elif kind in ("id", "isrc"):
+                values = [value.decode() for value in values]
+            columns.append(values)
+        return list(zip(*columns))
+
+    def tracks(self):
+        """Materialize slim tracks (only for snapshots of TRACK_COLUMNS)"""
+        return [row_track(row) for row in self.rows()]
+
+    def difference(self, other):
+        """
+        Sorted IDs (bytes) in this snapshot but not in `other`, computed
+        on the ID columns without building any rows.
+        """
+        import numpy as np
+
+        # sort + binary search, much faster than np.setdiff1d on strings
+        ids = np.sort(self.ids)
+        ids = ids[np.concatenate(([True], ids[1:] != ids[:-1]))] if len(ids) else ids
+        ids = ids[ids != b""]
+        if other is not None and len(other.ids) and len(ids):
+            others = np.sort(other.ids)
+            positions = np.minimum(np.searchsorted(others, ids), len(others) - 1)
+            ids = ids[others[positions] != ids]
+        return ids
+
+    def changes(self, previous):
+        """(added, removed) IDs compared to a previous snapshot (or None)"""
+        if previous is None:
+            return self.difference(None), self.ids[:0]
+        return self.difference(previous), previous.difference(self)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a snapshot file, delta snapshots load their base chain"""
+        import numpy as np
+
+        path = Path(path)
+        with open(path, "rb") as fhand:
+            data = mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = data[:8]
+        header_size = int.from_bytes(data[8:12], "little")
+        header = json.loads(data[12:12 + header_size])
+        columns = [tuple(column) for column in header["columns"]]
+        offset = 12 + header_size
+        offset += padding(offset)
+
+        if magic == FULL_MAGIC:
+            def array(dtype, count):
+                nonlocal offset
+                result = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+                offset += result.nbytes + padding(result.nbytes)
+                return result
+
+            offsets = array("<u4", header["strings"] + 1)
+            strings = memoryview(data)[offset:offset + int(offsets[-1])]
+            offset += int(offsets[-1]) + padding(int(offsets[-1]))
+            arrays = {name: array(COLUMN_TYPES[kind], header["count"]) for name, kind in columns}
+            return cls(columns, header["count"], strings, offsets, arrays, header["meta"], path)
+
+        if magic != DELTA_MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+        base = cls.load(path.parent / header["base"])
+        payload = zlib.decompress(data[offset:])
+        data.close()
+        return cls.apply_delta(base, header, payload, path)
+
+    @classmethod
+    def apply_delta(cls, base, header, payload, path):
+        import numpy as np
+
+        offset = 0
+        def array(dtype, count):
+            nonlocal offset
+            result = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+            offset += result.nbytes + padding(result.nbytes)
+            return result
+
+        # row sources are delta encoded: mostly runs of +1
+        sources = np.cumsum(array("<i4", header["count"]), dtype=np.int64)
+        new_offsets = array("<u4", header["strings"] + 1)
+        new_blob = payload[offset:offset + int(new_offsets[-1])]
+        offset += int(new_offsets[-1]) + padding(int(new_offsets[-1]))
+        added = {name: array(COLUMN_TYPES[kind], header["added"]) for name, kind in base.columns}
+
+        # source >= 0: row of the base, < 0: new row -source - 1
+        kept = sources >= 0
+        arrays = {}
+        for name, kind in base.columns:
+            column = np.empty(header["count"], dtype=COLUMN_TYPES[kind])
+            column[kept] = base.arrays[name][sources[kept]]
+            column[~kept] = added[name][-sources[~kept] - 1]
+            arrays[name] = column
+
+        base_size = int(base.offsets[-1])
+        offsets = np.concatenate((base.offsets, new_offsets[1:] + base_size)).astype("<u4")
+        strings = bytes(base.blob) + new_blob
+        return cls(base.columns, header["count"], strings, offsets, arrays, header["meta"],
+                   path, base.chain + 1)
+
+    @staticmethod
+    def chain_files(path):
+        """Names of the files a snapshot is read from (itself first)"""
+        path = Path(path)
+        names = []
+        while True:
+            names.append(path.name)
+            with open(path, "rb") as fhand:
+                if fhand.read(8) != DELTA_MAGIC:
+                    return names
+                header = json.loads(fhand.read(int.from_bytes(fhand.read(4), "little")))
+            path = path.parent / header["base"]
+
+    @classmethod
+    def write(cls, path, columns, rows, meta=None, base=None):
+        """
+        Write rows (tuples in `columns` order) to `path`. With a `base`
+        snapshot only the row sources and the changed rows are written
+        (rows equal to a base row with the same ID are not stored again),
+        unless the chain is MAX_CHAIN long or more than MAX_DELTA_ROWS of
+        the rows changed. Returns True if a delta was written.
+        """
+        import numpy as np
+
+        path = Path(path)
+        rows = list(rows)
+        if base is not None and (base.chain >= MAX_CHAIN or base.columns != columns or not len(base)):
+            base = None
+        strings = {}
+        if base is not None:
+            strings = {string: index for index, string in enumerate(base.string_list())}
+        base_strings = len(strings)
+
+        values = list(zip(*rows)) or [()] * len(columns)
+        arrays = {name: encode_column(kind, column, strings)
+                  for (name, kind), column in zip(columns, values)}
+
+        stored, sources = slice(None), None
+        if base is not None:
+            # rows equal to the base row with the same ID come from the base
+            ids = arrays["id"]
+            order = np.argsort(base.ids, kind="stable")
+            base_ids = base.ids[order]
+            positions = np.minimum(np.searchsorted(base_ids, ids), len(base_ids) - 1)
+            same = (ids != b"") & (base_ids[positions] == ids)
+            index = order[positions]
+            for name, _ in columns[1:]:
+                same &= base.arrays[name][index] == arrays[name]
+            stored = ~same
+            if stored.sum() > MAX_DELTA_ROWS * len(rows):
+                return cls.write(path, columns, rows, meta)
+            # new rows are numbered -1, -2, ...
+            sources = np.where(same, index, -np.cumsum(stored))
+
+        def string_table(strings_in):
+            blobs = [string.encode() for string in strings_in]
+            offsets = np.zeros(len(blobs) + 1, dtype="<u4")
+            np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+            return offsets, b"".join(blobs)
+
+        new_strings = list(strings)[base_strings:]
+        offsets, blob = string_table(new_strings)
+        header = {"columns": columns, "count": len(rows), "strings": len(new_strings),
+                  "meta": meta or {}}
+        sections = [offsets.tobytes(), blob] + [arrays[name][stored].tobytes() for name, _ in columns]
+
+        if base is None:
+            magic, body = FULL_MAGIC, sections
+        else:
+            magic = DELTA_MAGIC
+            header.update(base=base.path.name, added=int(stored.sum()))
+            deltas = np.diff(sources.astype(np.int64), prepend=0).astype("<i4")
+            body = [zlib.compress(b"".join(section + b"\0" * padding(len(section))
+                                           for section in [deltas.tobytes()] + sections), 1)]
+
+        header_bytes = json.dumps(header, separators=(",", ":")).encode()
+        fd, temp_file = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fhand:
+            fhand.write(magic + len(header_bytes).to_bytes(4, "little") + header_bytes)
+            fhand.write(b"\0" * padding(12 + len(header_bytes)))
+            for section in body:
+                fhand.write(section + b"\0" * padding(len(section)))
+        os.replace(temp_file, path)
+        return base is not None
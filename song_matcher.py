@@ -0,0 +1,189 @@
+import math
+from collections import defaultdict
+from local_library import normalize_key, song_key
+from track_model import Track
+
+# match tiers, from most to least reliable
+TIER_ID = "spotify_id"
+TIER_ISRC = "isrc"
+TIER_EXACT = "exact"
+TIER_TITLE = "title"
+TIER_FUZZY = "fuzzy"
+
+def artist_key(key, title_key):
+    """Normalized artist part of a song key ("" if the file has none)"""
+    return key.partition("|")[0] if key != title_key else ""
+
+def same_artist(artist, local_artist):
+    """
+    True if a title-only match is allowed: the local file has no artist
+    or its (normalized) artists include the track's first artist.
+    """
+    if not artist or not local_artist:
+        return True
+    return f" {artist} " in f" {local_artist} "
+
+def trigrams(key):
+    """Set of character trigrams of a normalized key"""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def track_fields(item):
+    """
+    Pull (spotify_id, isrc, title, artist) out of a playlist item or
+    track dict as returned by the Spotify API.
+    """
+    if isinstance(item, Track):
+        return item.id, item.isrc, item.name or "", item.artists[0] if item.artists else None
+    track = item.get("track", item) if isinstance(item, dict) else item
+    artists = track.get("artists") or []
+    artist = artists[0]["name"] if artists else None
+    isrc = (track.get("external_ids") or {}).get("isrc")
+    return track.get("id"), isrc, track.get("name", ""), artist
+
+
+class SongMatcher:
+    def __init__(self, songs, fuzzy_threshold=0.75):
+        """
+        Build hash tables over local songs. `songs` are rows of
+        (path, key, title_key, spotify_id, isrc) as given by
+        LibraryIndex.songs(), keys are already normalized.
+        """
+        self.fuzzy_threshold = fuzzy_threshold
+        self.by_id = {}
+        self.by_isrc = {}
+        self.by_key = {}
+        # title key -> indexes of the songs with that title
+        self.by_title = defaultdict(list)
+        self.titles = []
+        self.artists = []
+        self.paths = []
+
+        for path, key, title_key, spotify_id, isrc in songs:
+            if spotify_id:
+                self.by_id.setdefault(spotify_id, path)
+            if isrc:
+                self.by_isrc.setdefault(isrc.upper(), path)
+            if key != title_key:
+                self.by_key.setdefault(key, path)
+            self.by_title[title_key].append(len(self.paths))
+            self.titles.append(title_key)
+            self.artists.append(artist_key(key, title_key))
+            self.paths.append(path)
+
+        # trigram index is only built when something falls through
+        self.trigram_index = None
+        self.gram_sets = None
+        # local files already matched to a track can't be fuzzy matched again
+        self.claimed = set()
+
+    def build_trigram_index(self):
+        """
+        Map each trigram to the local songs containing it. Songs already
+        claimed by a match are left out.
+        """
+        self.trigram_index = defaultdict(list)
+        self.gram_sets = {}
+        for i, title_key in enumerate(self.titles):
+            if self.paths[i] in self.claimed:
+                continue
+            grams = trigrams(title_key)
+            self.gram_sets[i] = grams
+            for gram in grams:
+                self.trigram_index[gram].append(i)
+
+    def match_exact(self, spotify_id, isrc, title, artist):
+        """Hash join on IDs and normalized keys, returns (tier, path)"""
+        tier, path = None, None
+        if spotify_id and spotify_id in self.by_id:
+            tier, path = TIER_ID, self.by_id[spotify_id]
+        elif isrc and isrc.upper() in self.by_isrc:
+            tier, path = TIER_ISRC, self.by_isrc[isrc.upper()]
+        elif artist and song_key(title, artist) in self.by_key:
+            tier, path = TIER_EXACT, self.by_key[song_key(title, artist)]
+        else:
+            # same title by another artist is a different song
+            artist = normalize_key(artist)
+            for i in self.by_title.get(normalize_key(title), ()):
+                if same_artist(artist, self.artists[i]):
+                    tier, path = TIER_TITLE, self.paths[i]
+                    break
+
+        if path:
+            self.claimed.add(path)
+        return tier, path
+
+    def match_fuzzy(self, title, artist=None):
+        """
+        Best local song by trigram Dice coefficient, returns (score, path)
+        or (0, None). Songs by another artist are not candidates. A song scoring above the threshold must share at
+        least min_shared trigrams with the title, so it has to contain one
+        of the rarest len(grams) - min_shared + 1 of them: only those
+        posting lists are read to collect candidates.
+        """
+        if self.trigram_index is None:
+            self.build_trigram_index()
+
+        grams = trigrams(normalize_key(title))
+        threshold = self.fuzzy_threshold
+        min_shared = math.ceil(threshold * len(grams) / (2 - threshold))
+        # songs much shorter or longer than the title can't reach the threshold
+        min_len = threshold * len(grams) / (2 - threshold)
+        max_len = (2 - threshold) * len(grams) / threshold
+
+        # rarest trigrams first
+        rare = sorted(grams, key=lambda gram: len(self.trigram_index.get(gram, ())))
+        candidates = set()
+        for gram in rare[:len(grams) - min_shared + 1]:
+            candidates.update(self.trigram_index.get(gram, ()))
+
+        artist = normalize_key(artist)
+        best_score, best_path = 0, None
+        for i in candidates:
+            if self.paths[i] in self.claimed or not same_artist(artist, self.artists[i]):
+                continue
+            other = self.gram_sets[i]
+            if not min_len <= len(other) <= max_len:
+                continue
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            if score > best_score:
+                best_score, best_path = score, self.paths[i]
+
+        if best_score >= threshold:
+            self.claimed.add(best_path)
+            return best_score, best_path
+        return 0, None
+
+    def match(self, item):
+        """Match a single playlist track, returns (tier, path)"""
+        fields = track_fields(item)
+        tier, path = self.match_exact(*fields)
+        if tier is None:
+            score, path = self.match_fuzzy(fields[2], fields[3])
+            if path:
+                tier = TIER_FUZZY
+        return tier, path
+
+    def diff(self, spotify_tracks):
+        """
+        Match every playlist track against the local songs. Returns a
+        list of (item, tier, path) with tier None for missing songs.
+        """
+        results = []
+        leftovers = []
+
+        # tier 1: exact hash join
+        for item in spotify_tracks:
+            tier, path = self.match_exact(*track_fields(item))
+            if tier is None:
+                leftovers.append(len(results))
+            results.append((item, tier, path))
+
+        # tier 2: fuzzy match on whatever is left
+        for i in leftovers:
+            item = results[i][0]
+            score, path = self.match_fuzzy(*track_fields(item)[2:])
+            if path:
+                results[i] = (item, TIER_FUZZY, path)
+
+        return results
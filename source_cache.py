@@ -0,0 +1,165 @@
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from metrics import metrics
+
+CACHE_FILE = Path.home() / ".cache" / "music_downloader" / "sources.db"
+
+# resolved URLs go stale, "no source" is checked again after 1h, 2h,
+# 4h, ... up to 30 days
+TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 3600
+MAX_NEGATIVE_TTL = 30 * 24 * 3600
+
+class SourceCache:
+    def __init__(self, path=CACHE_FILE, max_entries=100_000, ttl=TTL,
+                 negative_ttl=NEGATIVE_TTL, max_negative_ttl=MAX_NEGATIVE_TTL):
+        """
+        Persistent cache of source resolutions keyed by Spotify track ID:
+        URL, source name and quality with an expiry time. "No source
+        found" is cached too, its expiry doubles on every failed check.
+        Least recently used entries are evicted above `max_entries`.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.inserts = 0
+        # losing the last entries on power loss is fine for a cache
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS sources (
+                track_id TEXT PRIMARY KEY,
+                url TEXT,
+                source TEXT,
+                quality TEXT,
+                expires REAL,
+                failures INTEGER DEFAULT 0,
+                used REAL
+            );
+            CREATE INDEX IF NOT EXISTS sources_used ON sources(used);
+        """)
+        self.conn.commit()
+
+    def get(self, track_id):
+        """
+        Cached entry {url, source, quality} (url None for "no source")
+        or None if unknown or expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT url, source, quality, expires, used FROM sources WHERE track_id = ?",
+                (track_id,)).fetchone()
+            if row is None or row[3] < now:
+                return None
+            # LRU with an hour resolution, hits rarely write
+            if now - row[4] > 3600:
+                self.conn.execute("UPDATE sources SET used = ? WHERE track_id = ?", (now, track_id))
+                self.conn.commit()
+        return {"url": row[0], "source": row[1], "quality": row[2]}
+
+    def put(self, track_id, url, source=None, quality=None):
+        """Store a resolved source"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (track_id, url, source, quality, now + self.ttl, now))
+            self.evict_locked()
+            self.conn.commit()
+
+    def put_missing(self, track_id):
+        """Store "no source found", re-checked after an exponentially growing time"""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT failures FROM sources WHERE track_id = ? AND url IS NULL",
+                                    (track_id,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            expires = now + min(self.max_negative_ttl, self.negative_ttl * 2 ** (failures - 1))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, NULL, NULL, NULL, ?, ?, ?)",
+                (track_id, expires, failures, now))
+            self.evict_locked()
+            self.conn.commit()
+
+    def invalidate(self, track_id):
+        """Forget a source (e.g. its URL stopped working)"""
+        with self.lock:
+            self.conn.execute("DELETE FROM sources WHERE track_id = ?", (track_id,))
+            self.conn.commit()
+
+    def evict_locked(self):
+        # the size is checked every 1% of max_entries inserts, eviction
+        # goes down to 90%
+        self.inserts += 1
+        if self.inserts % max(1, self.max_entries // 100) and self.inserts > 1:
+            return
+        count = self.conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM sources WHERE track_id IN (SELECT track_id FROM sources ORDER BY used LIMIT ?)",
+                (count - int(self.max_entries * 0.9),))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedResolver:
+    def __init__(self, resolve, cache=None):
+        """
+        Wrap a resolve_url(track) function in the source cache. `resolve`
+        returns a URL, a dict {url, source, quality} or None if there is
+        no source. Exceptions are passed on and not cached.
+        """
+        self.resolve = resolve
+        self.cache = cache if cache is not None else get_source_cache()
+
+    def __call__(self, track):
+        track = track.get("track", track)
+        track_id = track.get("id")
+        if not track_id:
+            return self.url(self.resolve(track))
+        entry = self.cache.get(track_id)
+        if entry is not None:
+            metrics.inc("source_cache_hits_total")
+            return entry["url"]
+        metrics.inc("source_cache_misses_total")
+
+        with metrics.stage("resolve"):
+            result = self.resolve(track)
+        url = self.url(result)
+        if url:
+            details = result if isinstance(result, dict) else {}
+            self.cache.put(track_id, url, details.get("source"), details.get("quality"))
+        else:
+            self.cache.put_missing(track_id)
+        return url
+
+    @staticmethod
+    def url(result):
+        return result.get("url") if isinstance(result, dict) else result
+
+    def invalidate(self, track_id):
+        self.cache.invalidate(track_id)
+
+
+_source_cache = None
+
+def get_source_cache():
+    """Source cache shared by every resolver of the process"""
+    global _source_cache
+    if _source_cache is None:
+        _source_cache = SourceCache()
+    return _source_cache
@@ -1,20 +1,302 @@
+import os
+import json
+import gzip
+import time
+import base64
+import secrets
+import sqlite3
+import threading
 import urllib.parse
-import requests
-from datetime import datetime, timedelta
-from flask import Flask, redirect, request, jasonify, session # use to create rest API's easily
+from pathlib import Path
+from dotenv import load_dotenv
+from flask import Flask, Response, redirect, request, jsonify, session # use to create rest API's easily
+from auth_api import SpotifyAPI, APIError, get_requester
+from playlist_cache import PlaylistCache, slim_track
+from metrics import metrics
 
+# Internal playlist service for our other tools. Run it under a multi-worker
+# WSGI server, e.g.:
+#
+#     gunicorn -w 4 --threads 8 -b 127.0.0.1:8080 spotify_api:app
+#
+# Nothing is opened at import time (sessions, SQLite connections are created
+# lazily), so workers can be forked from a preloaded app.
+load_dotenv()
 app = Flask(__name__)
-# access to flas session (store data somewhere and retrieve it later)
-app.secret_key="44rjtg8f9-887l-5720-abc4-7k777012731" # random key
 
-# app constants 
-CLIENT_ID = ""
-CLIENT_SECRET = ""
-REDIRECT_URL = "http://localhost:8080/callback"
+# app constants, the Spotify URLs can point to a local fake upstream (fake_server)
+CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID", "")
+CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET", "")
+REDIRECT_URL = os.getenv("SPOTIFY_REDIRECT_URL", "http://localhost:8080/callback")
 
-AUTH_URL = "https://accounts.spotify.com/authorize"
-TOKEN_URL = "https://accounts.spotify.com/api/token"
-API_BASE_URL = "https://api.spotify.com/v1/"
+AUTH_URL = os.getenv("SPOTIFY_AUTH_URL", "https://accounts.spotify.com/authorize")
+TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+API_BASE_URL = os.getenv("SPOTIFY_API_BASE_URL", "https://api.spotify.com/v1")
+SCOPE = "user-read-private playlist-read-private playlist-read-collaborative"
+
+# tokens and the cookie secret, shared by all workers
+STORE_FILE = Path(os.getenv("SPOTIFY_API_STORE", Path.home() / ".cache" / "music_downloader" / "service.db"))
+# a cached playlist is served without asking Spotify for this long
+SNAPSHOT_TTL = float(os.getenv("SPOTIFY_API_SNAPSHOT_TTL", 5))
+# tokens are refreshed this long before they expire
+REFRESH_MARGIN = 60
+
+# user key of the service's own login (SPOTIFY_REFRESH_TOKEN in .env),
+# serves public playlists to requests without a login session
+SERVICE_USER = "service"
+# upstream statuses passed on to our clients, other errors become 502
+PASSED_STATUSES = (401, 404, 429)
+
+class LoginRequired(Exception):
+    pass
+
+
+class TokenStore:
+    def __init__(self, path=STORE_FILE):
+        """
+        Server-side token store (SQLite in WAL mode, shared by the worker
+        processes). The cookie session only holds a random user key,
+        tokens never leave the server.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS tokens (
+                user TEXT PRIMARY KEY,
+                access_token TEXT,
+                refresh_token TEXT,
+                expires_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.conn.commit()
+
+    def get(self, user):
+        """Token {access_token, refresh_token, expires_at} of a user or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT access_token, refresh_token, expires_at FROM tokens WHERE user = ?",
+                (user,)).fetchone()
+        if row is None:
+            return None
+        return {"access_token": row[0], "refresh_token": row[1], "expires_at": row[2]}
+
+    def put(self, user, access_token, refresh_token, expires_at):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                              (user, access_token, refresh_token, expires_at))
+            self.conn.commit()
+
+    def delete(self, user):
+        with self.lock:
+            self.conn.execute("DELETE FROM tokens WHERE user = ?", (user,))
+            self.conn.commit()
+
+    def secret_key(self):
+        """Cookie signing key, the first worker creates it, the others read it"""
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO settings VALUES ('secret_key', ?)",
+                              (secrets.token_hex(32),))
+            self.conn.commit()
+            return self.conn.execute("SELECT value FROM settings WHERE key = 'secret_key'").fetchone()[0]
+
+
+def token_request(data):
+    """POST to the token endpoint with the app credentials (Basic auth)"""
+    credentials = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+    headers = {
+        "Authorization": f"Basic {credentials}",
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    response = get_requester().post(TOKEN_URL, headers=headers, data=data)
+    if response.status_code != 200:
+        raise LoginRequired(f"Token request failed ({response.status_code})")
+    return response.json()
+
+
+class StoredToken:
+    # one refresh per user and process at a time
+    refresh_locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, store, user):
+        """Auth object for SpotifyAPI backed by the token store"""
+        self.store = store
+        self.user = user
+
+    def get_access_token(self):
+        token = self.store.get(self.user)
+        if token is None and self.user == SERVICE_USER and os.getenv("SPOTIFY_REFRESH_TOKEN"):
+            # first use of the service login: refreshed right away
+            token = {"access_token": None, "refresh_token": os.getenv("SPOTIFY_REFRESH_TOKEN"),
+                     "expires_at": 0}
+        if token is None:
+            raise LoginRequired("Not logged in")
+        if token["expires_at"] - REFRESH_MARGIN > time.time():
+            return token["access_token"]
+
+        with self.locks_lock:
+            lock = self.refresh_locks.setdefault(self.user, threading.Lock())
+        with lock:
+            # another thread (or worker) may have refreshed in the meantime
+            current = self.store.get(self.user) or token
+            if current["expires_at"] - REFRESH_MARGIN > time.time():
+                return current["access_token"]
+            tokens = token_request({"grant_type": "refresh_token",
+                                    "refresh_token": current["refresh_token"]})
+            self.store.put(self.user, tokens["access_token"],
+                           tokens.get("refresh_token", current["refresh_token"]),
+                           time.time() + tokens["expires_in"])
+            metrics.inc("service_token_refreshes_total")
+            return tokens["access_token"]
+
+
+class PlaylistResponses:
+    def __init__(self, disk_cache=None, ttl=SNAPSHOT_TTL):
+        """
+        Encoded /playlist responses per playlist: the JSON body, its gzip
+        version and the snapshot_id it belongs to. An entry is trusted for
+        `ttl` seconds (per user, so nobody reads a playlist they have no
+        access to), after that one cheap snapshot request with the ETag
+        of the last one tells if the playlist changed. Tracks are kept in
+        the PlaylistCache too, so other workers and restarts only pay the
+        snapshot request. Concurrent requests for a playlist share one
+        upstream fetch. The snapshot request also tells if the playlist is
+        public, which is all the service login may serve.
+        """
+        self.disk_cache = disk_cache or PlaylistCache()
+        self.ttl = ttl
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def playlist_lock(self, playlist_id):
+        with self.lock:
+            return self.locks.setdefault(playlist_id, threading.Lock())
+
+    def fresh(self, entry, user):
+        return entry is not None and time.monotonic() - entry["checked"].get(user, -self.ttl) < self.ttl
+
+    def get(self, api, user, playlist_id):
+        entry = self.entries.get(playlist_id)
+        if self.fresh(entry, user):
+            metrics.inc("service_playlist_hits_total")
+            return entry
+
+        with self.playlist_lock(playlist_id):
+            entry = self.entries.get(playlist_id)
+            if self.fresh(entry, user):
+                metrics.inc("service_playlist_hits_total")
+                return entry
+
+            # a new worker starts from the stored snapshot, its tracks are
+            # only built if it is still current
+            snapshot = None if entry is not None else self.disk_cache.snapshot(playlist_id)
+            # (an empty Snapshot is falsy, so compare with None)
+            cached = entry if entry is not None else snapshot.meta if snapshot is not None else None
+            # the ETag of a version stored without the public flag (by
+            # get_playlist_tracks) is for other fields, it is not sent
+            etag = cached and "public" in cached and cached["etag"]
+            meta, etag = api.get_playlist_meta(playlist_id, fields="snapshot_id,public", etag=etag)
+            if cached and (meta is None or meta["snapshot_id"] == cached["snapshot_id"]):
+                metrics.inc("service_playlist_revalidated_total")
+                if entry is None:
+                    entry = self.encode(playlist_id, cached["snapshot_id"], cached["etag"],
+                                        snapshot.tracks(), cached.get("public"))
+                if meta is not None:
+                    # same tracks, the public flag may have changed
+                    entry["etag"], entry["public"] = etag, meta.get("public")
+            else:
+                metrics.inc("service_playlist_misses_total")
+                with metrics.stage("service_playlist_fetch"):
+                    tracks = [slim_track(item) for item in api.get_playlist(playlist_id) if item.get("track")]
+                self.disk_cache.put(playlist_id, meta["snapshot_id"], etag, tracks, public=meta.get("public"))
+                entry = self.encode(playlist_id, meta["snapshot_id"], etag, tracks, meta.get("public"))
+
+            entry["checked"][user] = time.monotonic()
+            self.entries[playlist_id] = entry
+            return entry
+
+    @staticmethod
+    def encode(playlist_id, snapshot_id, etag, tracks, public=None):
+        """Serialize and compress once, every request reuses the bytes"""
+        body = json.dumps({"id": playlist_id, "snapshot_id": snapshot_id, "total": len(tracks),
+                           "tracks": tracks}, separators=(",", ":")).encode()
+        return {"snapshot_id": snapshot_id, "etag": etag, "public": public, "checked": {},
+                "body": body, "gzip": gzip.compress(body, compresslevel=6)}
+
+
+# per process, created on first use (after the WSGI server forked)
+_store = None
+_responses = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = TokenStore()
+    return _store
+
+def get_responses():
+    global _responses
+    if _responses is None:
+        _responses = PlaylistResponses()
+    return _responses
+
+def current_user():
+    """User key of the login session, raises LoginRequired without one"""
+    if "user" not in session:
+        raise LoginRequired("Not logged in")
+    return session["user"]
+
+def get_api(user):
+    return SpotifyAPI(auth=StoredToken(get_store(), user), base_url=API_BASE_URL)
+
+def json_response(body, gzipped=None, etag=None):
+    """
+    JSON response with a weak ETag (304 if the client has it) and gzip
+    if the client accepts it.
+    """
+    response = Response(status=200, mimetype="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+    # clients may keep it but have to revalidate
+    response.headers["Cache-Control"] = "private, no-cache"
+    if etag:
+        response.set_etag(etag, weak=True)
+        if request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+            return response
+
+    if request.accept_encodings["gzip"]:
+        response.set_data(gzipped if gzipped is not None else gzip.compress(body, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response.set_data(body)
+    return response
+
+@app.before_request
+def load_secret_key():
+    if not app.secret_key:
+        app.secret_key = os.getenv("FLASK_SECRET_KEY") or get_store().secret_key()
+
+@app.errorhandler(LoginRequired)
+def login_required(error):
+    return jsonify({"error": str(error), "login": "/login"}), 401
+
+@app.errorhandler(APIError)
+def upstream_error(error):
+    status = error.status_code if error.status_code in PASSED_STATUSES else 502
+    response = jsonify({"error": f"Spotify request failed ({error.status_code})",
+                        **({"login": "/login"} if status == 401 else {})})
+    response.status_code = status
+    if status == 429 and error.retry_after:
+        response.headers["Retry-After"] = error.retry_after
+    return response
 
 @app.route("/")
 def index():
@@ -23,92 +305,79 @@ def index():
 # endpoint to redirect to spotify login page
 @app.route("/login")
 def login():
-    # permissions scopes requeired (the two bellow)
-    scope = "user-read-private user-read-email"
-
+    # checked by the callback, protects against forged callbacks
+    session["state"] = secrets.token_urlsafe(16)
     parameters = {
-        "client_id" : CLIENT_ID,
-        "response_type" : "code",
-        "scope" : scope,
-        "redirect_url" : REDIRECT_URL,
-        "show_dialog" : True              #debugging purpose (check login)
+        "client_id": CLIENT_ID,
+        "response_type": "code",
+        "scope": SCOPE,
+        "redirect_uri": REDIRECT_URL,
+        "state": session["state"],
     }
-    # authentification url; can be done using request but spotify offers a url
-    # that acts as a request.get 
-    auth_url  = f"{AUTH_URL}?{urllib.parse.urlencode(parameters)}"
-
-    return redirect(auth_url)
+    return redirect(f"{AUTH_URL}?{urllib.parse.urlencode(parameters)}")
 
-# callback endpoint: retrun link after loging into spotify
-@app.route("/callbalck")
+# callback endpoint: return link after logging into spotify
+@app.route("/callback")
 def callback():
-    # if log in is not succesful 
+    # if log in is not successful
     if "error" in request.args:
-        return jasonify({"error": request.args["error"]})
-    
-    # if code aka succesful login -> request body building to get access_token
-    if "code" in request.args:
-        req_body = {
-            "code": request.args["code"],
-            "grant_time": "authorization_code",
-            "redirect_url": REDIRECT_URL,
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET
-        }
-        # send request
-        response = request.post(TOKEN_URL, data=req_body)
-        # get token information
-        token_info = response.json()
-
-        session["access_token"] = token_info["access_token"]
-        session["refresh_token"] = token_info["refresh_token"]
-        # create time stamp when token expiress 
-        session["expires_at"] = datetime.now().timestamp() + token_info["expires_in"]
-
-        return redirect("/playlist")
-    
-    @app.route("/playlist")
-    def get_playlist():
-        # check it access token was stored in session, if not go to login
-        if "access_token" not in session:
-            return redirect("/login")
-        
-        # get new acess token via refresh token
-        if datetime.now().timestamp() > session["expires_at"]:
-            return redirect("/refresh-token")
-        
-        # retrieve users laylist 
-        headers = {
-            "Authorization" - f"Bearer {session["access_token"]}",
-        }
-        # ask for playlist
-        respose = request.get(API_BASE_URL + "me/playlist", headers=headers)
-        playlists = response.json() # extract playlists 
-
-        return jasonify(playlists)
-
-app.route("/refresh-token")
-def refresh_token():
-
-    if "refresh_token" not in session:
-        return redirect("/login")
-    
-    if datetime.now().timestamp() > session["expires_at"]:
-        req_body = {
-            "grant_type": "refresh_token",
-            "refresh_token": session["refresh_token"],
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET
-        }
-
-        # send info 
-        response = request.post(TOKEN_URL, data=req_body)
-        new_token_info = response.json()
-        # update session
-        session["access_token"] = new_token_info["access_token"]
-        session["expire_at"] = datetime.now().timestamp + new_token_info["expires_in"]
-
-    return redirect("/playlist")
+        return jsonify({"error": request.args["error"]}), 400
+    if "code" not in request.args or request.args.get("state") != session.pop("state", None):
+        return jsonify({"error": "invalid callback"}), 400
+
+    # code aka successful login -> exchange it for tokens
+    tokens = token_request({
+        "grant_type": "authorization_code",
+        "code": request.args["code"],
+        "redirect_uri": REDIRECT_URL,
+    })
+    # tokens stay on the server, the cookie gets a random key
+    user = secrets.token_urlsafe(16)
+    get_store().put(user, tokens["access_token"], tokens.get("refresh_token"),
+                    time.time() + tokens["expires_in"])
+    session["user"] = user
+    return redirect("/playlists")
+
+@app.route("/logout")
+def logout():
+    user = session.pop("user", None)
+    if user:
+        get_store().delete(user)
+    return redirect("/")
+
+@app.route("/playlists")
+def get_playlists():
+    """Playlists of the user (not cached, they change with every edit)"""
+    api = get_api(current_user())
+    playlists = []
+    url = f"{api.base_url}/me/playlists"
+    params = {"limit": 50}
+    while url:
+        page = api.get_json(url, params=params)
+        playlists += [{"id": item["id"], "name": item["name"], "snapshot_id": item.get("snapshot_id"),
+                       "total": (item.get("tracks") or {}).get("total")} for item in page["items"]]
+        url, params = page.get("next"), None
+    body = json.dumps({"playlists": playlists}, separators=(",", ":")).encode()
+    return json_response(body)
+
+@app.route("/playlist/<playlist_id>")
+def get_playlist(playlist_id):
+    """
+    Slim tracks of a playlist, cached until its snapshot_id changes.
+    Without a login only public playlists are served (with the service
+    login).
+    """
+    user = session.get("user", SERVICE_USER)
+    with metrics.stage("service_playlist"):
+        entry = get_responses().get(get_api(user), user, playlist_id)
+    if user == SERVICE_USER and not entry["public"]:
+        raise LoginRequired("Playlist is not public")
+    return json_response(entry["body"], entry["gzip"], etag=entry["snapshot_id"])
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=True)
\ No newline at end of file
+    # development server, see the top of the file for production
+    app.run(host="127.0.0.1", port=8080, threaded=True)
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+# kept next to the library index so appends and compactions never
+# change the mtime of the library root
+JOURNAL_DIR = ".library"
+JOURNAL_FILE = "sync.journal"
+
+# per-track states, a track only moves forward through them
+PLANNED = "planned"
+DOWNLOADING = "downloading"
+DONE = "done"
+TAGGED = "tagged"
+FAILED = "failed"
+FINISHED = {TAGGED, FAILED}
+
+class SyncJournal:
+    def __init__(self, root=".", sync_every=64, sync_interval=1.0, compact_after=1000):
+        """
+        Append-only journal of sync runs, one JSON record per line:
+
+            {"op": "run", "playlist": ...}                start of a run
+            {"op": "track", "playlist": ..., "key": ..., "state": ...}
+            {"op": "end", "playlist": ...}                run completed
+
+        Every record is written to the OS right away, so a crashed process
+        loses nothing; fsync is batched (every `sync_every` records or
+        `sync_interval` seconds). On open the journal is replayed and a
+        torn last line is cut off. Once it holds `compact_after` records
+        and mostly stale ones, it is rewritten with one record per track
+        of the unfinished runs.
+        """
+        self.folder = Path(root) / JOURNAL_DIR
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.path = self.folder / JOURNAL_FILE
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+
+        # playlist id -> {track key -> merged track record} of unfinished runs
+        self.runs = {}
+        self.records = 0
+        self.lock = threading.Lock()
+
+        self.replay()
+        self.fhand = open(self.path, "a", encoding="utf-8")
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def replay(self):
+        """Rebuild the state of unfinished runs from the journal"""
+        if not self.path.exists():
+            return
+        good = 0
+        with open(self.path, "rb") as fhand:
+            for line in fhand:
+                # a crash can leave half a record at the end
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.apply(record)
+                good += len(line)
+                self.records += 1
+        if good != self.path.stat().st_size:
+            os.truncate(self.path, good)
+
+    def apply(self, record):
+        playlist = record.get("playlist")
+        if record["op"] == "run":
+            self.runs[playlist] = {}
+        elif record["op"] == "end":
+            self.runs.pop(playlist, None)
+        elif record["op"] == "track" and playlist in self.runs:
+            self.runs[playlist].setdefault(record["key"], {}).update(record)
+
+    def append(self, record):
+        with self.lock:
+            self.apply(record)
+            self.fhand.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.fhand.flush()
+            self.records += 1
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_every or record["op"] == "end"
+                    or time.monotonic() - self.last_sync >= self.sync_interval):
+                self.sync_locked()
+            if self.records >= self.compact_after and self.records > 4 * self.live_records():
+                self.compact_locked()
+
+    def sync_locked(self):
+        if self.unsynced:
+            os.fsync(self.fhand.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        """Force the pending records to disk"""
+        with self.lock:
+            self.sync_locked()
+
+    def live_records(self):
+        return sum(len(tracks) + 1 for tracks in self.runs.values())
+
+    def compact_locked(self):
+        """Rewrite the journal with only the state of unfinished runs"""
+        temp_file = self.path.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as fhand:
+            for playlist, tracks in self.runs.items():
+                fhand.write(json.dumps({"op": "run", "playlist": playlist}) + "\n")
+                for record in tracks.values():
+                    fhand.write(json.dumps(record, separators=(",", ":")) + "\n")
+            fhand.flush()
+            os.fsync(fhand.fileno())
+
+        self.fhand.close()
+        os.replace(temp_file, self.path)
+        self.fhand = open(self.path, "a", encoding="utf-8")
+        self.records = self.live_records()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def start(self, playlist):
+        """Start a new run of a playlist (drops an unfinished one)"""
+        self.append({"op": "run", "playlist": playlist})
+
+    def record(self, playlist, key, state, **fields):
+        """Record a state transition of a track, extra fields are kept"""
+        self.append({"op": "track", "playlist": playlist, "key": key, "state": state, **fields})
+
+    def end(self, playlist):
+        """Mark the run of a playlist as completed"""
+        self.append({"op": "end", "playlist": playlist})
+
+    def pending(self, playlist):
+        """
+        Track records of the unfinished run of a playlist or None if
+        there is none (the last run completed or never started).
+        """
+        with self.lock:
+            tracks = self.runs.get(playlist)
+            return None if tracks is None else [dict(record) for record in tracks.values()]
+
+    def close(self):
+        with self.lock:
+            self.sync_locked()
+            self.fhand.close()
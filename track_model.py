@@ -0,0 +1,234 @@
+import sys
+from array import array
+from snapshot import SEPARATOR, fit_value
+
+# fixed widths of the ID columns (Spotify IDs are 22 base62 characters)
+ID_WIDTH = 22
+ISRC_WIDTH = 12
+
+def intern(string):
+    return sys.intern(string) if string else ""
+
+def fixed(value, kind, width):
+    """
+    Value padded to a fixed-width column entry, too long values are
+    normalized or dropped like in snapshots (see snapshot.fit_value)
+    """
+    return fit_value(kind, value or "").ljust(width, b"\0")
+
+def unfixed(data):
+    return data.rstrip(b"\0").decode() or None
+
+
+class Track:
+    # no per instance __dict__, rarely used fields (release date, genres,
+    # ...) live in `extra` which is only created when needed
+    __slots__ = ("id", "name", "artists", "artist_ids", "album", "album_id", "isrc",
+                 "track_number", "duration_ms", "extra")
+
+    def __init__(self, id=None, name=None, artists=(), artist_ids=(), album=None, album_id=None,
+                 isrc=None, track_number=None, duration_ms=None, extra=None):
+        """
+        Compact track. Artist and album names are interned, so the
+        tracks of an artist share one string. Reads like a slim track
+        dict (get / [] with the same keys), so code written for API JSON
+        takes a Track as is.
+        """
+        self.id = id
+        self.name = name
+        self.artists = artists
+        self.artist_ids = artist_ids
+        self.album = album
+        self.album_id = album_id
+        self.isrc = isrc
+        self.track_number = track_number
+        self.duration_ms = duration_ms
+        self.extra = extra
+
+    @classmethod
+    def from_item(cls, item):
+        """Track from a playlist item or track JSON (slim or full)"""
+        track = item.get("track", item) or {}
+        artists = track.get("artists") or []
+        album = track.get("album") or {}
+        return cls(
+            track.get("id"),
+            track.get("name"),
+            tuple(intern(artist.get("name")) for artist in artists),
+            tuple(artist.get("id") or "" for artist in artists),
+            intern(album.get("name")) or None,
+            album.get("id"),
+            (track.get("external_ids") or {}).get("isrc"),
+            track.get("track_number"),
+            track.get("duration_ms"),
+        )
+
+    def to_dict(self):
+        """Slim track dict (playlist_cache.slim_track) plus extra fields"""
+        return {key: self.get(key) for key in DICT_FIELDS} | (self.extra or {})
+
+    def get(self, key, default=None):
+        field = DICT_FIELDS.get(key)
+        if field is not None:
+            return field(self)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in DICT_FIELDS or bool(self.extra and key in self.extra)
+
+    def __repr__(self):
+        return f"Track({self.id!r}, {self.name!r}, {', '.join(self.artists)!r})"
+
+
+# slim track dict keys and how a Track provides them
+DICT_FIELDS = {
+    "id": lambda track: track.id,
+    "name": lambda track: track.name,
+    "artists": lambda track: [{"id": artist_id or None, "name": name or None}
+                              for artist_id, name in zip(track.artist_ids, track.artists)],
+    "album": lambda track: {"id": track.album_id, "name": track.album},
+    "external_ids": lambda track: {"isrc": track.isrc},
+    "track_number": lambda track: track.track_number,
+    "duration_ms": lambda track: track.duration_ms,
+}
+
+
+class TrackList:
+    def __init__(self):
+        """
+        Array-backed list of tracks: IDs and ISRCs in fixed-width byte
+        columns, strings (names, joined artists, albums) stored once in a
+        pool and referenced by index, numbers in typed arrays. About 80
+        bytes per track plus the distinct strings, instead of a dict tree
+        per track. Indexing builds a Track on access.
+        """
+        self.strings = []
+        self.string_index = {}
+        self.ids = bytearray()
+        self.names = array("I")
+        self.artists = array("I")
+        self.artist_ids = array("I")
+        self.albums = array("I")
+        self.album_ids = bytearray()
+        self.isrcs = bytearray()
+        self.track_numbers = array("H")
+        self.durations = array("I")
+        # index -> dict of rarely used fields
+        self.extra = {}
+
+    def string(self, value):
+        """Pool index of a string, added if new"""
+        value = value or ""
+        index = self.string_index.get(value)
+        if index is None:
+            index = self.string_index[value] = len(self.strings)
+            self.strings.append(intern(value))
+        return index
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Build from playlist items as they are streamed (e.g. from
+        SpotifyAPI.get_playlist), no raw page is kept. Items without a
+        track (deleted, local files) are skipped.
+        """
+        tracks = cls()
+        for item in items:
+            if item.get("track", item):
+                tracks.append(item)
+        return tracks
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Build from a TRACK_COLUMNS snapshot (see snapshot) without dicts"""
+        tracks = cls()
+        tracks.strings = [intern(string) for string in snapshot.string_list()]
+        tracks.string_index = {string: index for index, string in enumerate(tracks.strings)}
+        tracks.ids = bytearray(snapshot["id"].tobytes())
+        tracks.album_ids = bytearray(snapshot["album_id"].tobytes())
+        tracks.isrcs = bytearray(snapshot["isrc"].tobytes())
+        for name, column in (("name", tracks.names), ("artists", tracks.artists),
+                             ("artist_ids", tracks.artist_ids), ("album", tracks.albums)):
+            column.frombytes(snapshot[name].astype("=u4").tobytes())
+        tracks.track_numbers.frombytes(snapshot["track_number"].astype("=u2").tobytes())
+        tracks.durations.frombytes(snapshot["duration_ms"].astype("=u4").tobytes())
+        return tracks
+
+    def append(self, item):
+        """Add a track from a Track or (slim, full or playlist item) JSON"""
+        track = item if isinstance(item, Track) else Track.from_item(item)
+        self.ids += fixed(track.id, "id", ID_WIDTH)
+        self.names.append(self.string(track.name))
+        self.artists.append(self.string(SEPARATOR.join(track.artists)))
+        self.artist_ids.append(self.string(SEPARATOR.join(track.artist_ids)))
+        self.albums.append(self.string(track.album))
+        self.album_ids += fixed(track.album_id, "id", ID_WIDTH)
+        self.isrcs += fixed(track.isrc, "isrc", ISRC_WIDTH)
+        self.track_numbers.append(track.track_number or 0)
+        self.durations.append(track.duration_ms or 0)
+        if track.extra:
+            self.extra[len(self.names) - 1] = track.extra
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, index):
+        """ID of track `index` without building the Track"""
+        return unfixed(self.ids[index * ID_WIDTH:(index + 1) * ID_WIDTH])
+
+    def split(self, index):
+        value = self.strings[index]
+        return tuple(value.split(SEPARATOR)) if value else ()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("track index out of range")
+        artists = self.split(self.artists[index])
+        return Track(
+            self.id(index),
+            self.strings[self.names[index]] or None,
+            artists,
+            self.split(self.artist_ids[index]) or ("",) * len(artists),
+            self.strings[self.albums[index]] or None,
+            unfixed(self.album_ids[index * ID_WIDTH:(index + 1) * ID_WIDTH]),
+            unfixed(self.isrcs[index * ISRC_WIDTH:(index + 1) * ISRC_WIDTH]),
+            self.track_numbers[index] or None,
+            self.durations[index] or None,
+            self.extra.get(index),
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def rows(self):
+        """Rows of snapshot.TRACK_COLUMNS, for PlaylistCache.put"""
+        strings = self.strings
+        for index in range(len(self)):
+            yield (
+                self.id(index) or "",
+                strings[self.names[index]],
+                strings[self.artists[index]],
+                strings[self.artist_ids[index]],
+                unfixed(self.album_ids[index * ID_WIDTH:(index + 1) * ID_WIDTH]) or "",
+                strings[self.albums[index]],
+                unfixed(self.isrcs[index * ISRC_WIDTH:(index + 1) * ISRC_WIDTH]) or "",
+                self.track_numbers[index],
+                self.durations[index],
+            )
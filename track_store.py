@@ -0,0 +1,103 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+STORE_DIR = ".store"
+# song name -> content hash of the stored tracks without Spotify ID
+ALIASES_FILE = "aliases.json"
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """sha256 of a file, used as key for tracks without Spotify ID"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fhand:
+        while chunk := fhand.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TrackStore:
+    def __init__(self, root, extension=".mp3"):
+        """
+        Content-addressed store shared by all playlists: every track is
+        kept once as "<root>/.store/<spotify id or sha256>.mp3" and the
+        playlist folders are built from links to it. Tracks without ID
+        are found again by name through the aliases file.
+        """
+        self.root = Path(root)
+        self.store_dir = self.root / STORE_DIR
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.extension = extension
+        self.aliases_path = self.store_dir / ALIASES_FILE
+        try:
+            self.aliases = json.loads(self.aliases_path.read_text())
+        except FileNotFoundError:
+            self.aliases = {}
+
+    def filename(self, key):
+        return f"{key}{self.extension}"
+
+    def path(self, key):
+        return self.store_dir / self.filename(key)
+
+    def has(self, key):
+        return self.path(key).exists()
+
+    def add(self, src, key=None, keep=False):
+        """
+        Move a file into the store, keyed by hash if no key is given.
+        With `keep` the file stays where it is and the store gets a
+        hardlink (a copy on another filesystem). Returns the key.
+        """
+        key = key or file_hash(src)
+        if self.has(key):
+            if not keep:
+                os.remove(src)
+        elif not keep:
+            os.replace(src, self.path(key))
+        else:
+            try:
+                os.link(src, self.path(key))
+            except OSError:
+                shutil.copy2(src, self.path(key))
+        return key
+
+    def alias(self, name):
+        """Key of a track without ID stored under `name`, None if unknown"""
+        key = self.aliases.get(name)
+        return key if key and self.has(key) else None
+
+    def set_alias(self, name, key):
+        self.aliases[name] = key
+        temp_file = self.aliases_path.with_suffix(".tmp")
+        temp_file.write_text(json.dumps(self.aliases))
+        os.replace(temp_file, self.aliases_path)
+
+    def link(self, key, dest):
+        """
+        Make `dest` point to the stored track: hardlink if possible,
+        symlink as fallback (other filesystem), copy as last resort.
+        Returns the kind of link created or None if dest already exists.
+        """
+        dest = Path(dest)
+        if dest.exists() or dest.is_symlink():
+            return None
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+        src = self.path(key)
+        try:
+            os.link(src, dest)
+            return "hardlink"
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.relpath(src, dest.parent), dest)
+            return "symlink"
+        except OSError:
+            shutil.copy2(src, dest)
+            return "copy"
+
+    def keys(self):
+        """Keys of all stored tracks"""
+        return {path.name[:-len(self.extension)] for path in self.store_dir.glob(f"*{self.extension}")}
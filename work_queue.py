@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import random
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+# item states: pending -> claimed -> done / failed, a claimed item whose
+# lease ran out is claimed again by the next worker asking for work
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+
+# seconds a claim is valid without a heartbeat
+LEASE = 60.0
+
+def worker_name():
+    """Unique worker ID (host, process and a random part)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(24):06x}"
+
+
+class WorkQueue:
+    def __init__(self, path, lease=LEASE, max_attempts=3, timeout=30.0):
+        """
+        Sync plan shared by several workers (processes or hosts) through
+        one SQLite file. Workers claim batches of items under a lease and
+        extend it with heartbeats while they work. Items of a worker that
+        died or hangs are claimed again once their lease ran out, an item
+        is given up after `max_attempts` claims.
+
+        Every claim is one short write transaction, so workers scale as
+        long as an item takes much longer than a claim (batches help).
+        SQLite needs working file locks: a local disk shared by processes
+        is fine, network filesystems often are not.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        # transactions are started explicitly (BEGIN IMMEDIATE)
+        self.conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS items (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                playlist TEXT,
+                track TEXT,
+                filename TEXT,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS items_state ON items(state, seq);
+            CREATE INDEX IF NOT EXISTS items_lease ON items(state, lease_until);
+        """)
+
+    def transaction(self, function, *args):
+        """Run function(*args) in a write transaction, returns its result"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def plan(self, playlist, entries):
+        """
+        Add work items, `entries` are dicts with key, track and filename.
+        Keys already pending or claimed are skipped, failed and done ones
+        are queued again (a planner only plans songs missing locally, so
+        the file of a done item is gone). Returns the number of items
+        added or reset.
+        """
+        now = time.time()
+        rows = [(entry["key"], playlist, json.dumps(entry["track"]), entry["filename"], now)
+                for entry in entries]
+
+        def insert():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT INTO items (key, playlist, track, filename, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = 'pending', worker = NULL, attempts = 0, "
+                "error = NULL, updated = excluded.updated WHERE state IN ('failed', 'done')", rows)
+            return self.conn.total_changes - before
+
+        return self.transaction(insert)
+
+    def claim(self, worker, batch=16):
+        """
+        Claim up to `batch` items for `worker`: expired claims first, then
+        pending items in plan order. Returns dicts with key, playlist,
+        track, filename and attempts.
+        """
+        now = time.time()
+
+        def claim_items():
+            # claims that expired too often are given up
+            self.conn.execute(
+                "UPDATE items SET state = 'failed', error = 'lease expired', updated = ? "
+                "WHERE state = 'claimed' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts))
+            seqs = [row[0] for row in self.conn.execute(
+                "SELECT seq FROM items WHERE state = 'claimed' AND lease_until < ? LIMIT ?",
+                (now, batch))]
+            seqs += [row[0] for row in self.conn.execute(
+                "SELECT seq FROM items WHERE state = 'pending' ORDER BY seq LIMIT ?",
+                (batch - len(seqs),))]
+            if not seqs:
+                return []
+            # read, then update in the same transaction (no RETURNING,
+            # which needs SQLite 3.35)
+            placeholders = ", ".join("?" * len(seqs))
+            rows = self.conn.execute(
+                "SELECT seq, key, playlist, track, filename, attempts + 1 FROM items "
+                f"WHERE seq IN ({placeholders}) ORDER BY seq", seqs).fetchall()
+            self.conn.execute(
+                "UPDATE items SET state = 'claimed', worker = ?, lease_until = ?, "
+                f"attempts = attempts + 1, updated = ? WHERE seq IN ({placeholders})",
+                (worker, now + self.lease, now, *seqs))
+            return rows
+
+        return [{"key": key, "playlist": playlist, "track": json.loads(track),
+                 "filename": filename, "attempts": attempts}
+                for _, key, playlist, track, filename, attempts in self.transaction(claim_items)]
+
+    def heartbeat(self, worker):
+        """Extend the leases of all items claimed by `worker`, returns their number"""
+        def extend():
+            return self.conn.execute(
+                "UPDATE items SET lease_until = ? WHERE state = 'claimed' AND worker = ?",
+                (time.time() + self.lease, worker)).rowcount
+        return self.transaction(extend)
+
+    def complete(self, worker, key, state=DONE, error=None):
+        """
+        Record the result of an item. Only applies while `worker` still
+        holds the claim, returns False if the lease was lost to another
+        worker (whose result counts then).
+        """
+        def update():
+            return self.conn.execute(
+                "UPDATE items SET state = ?, error = ?, worker = NULL, lease_until = NULL, "
+                "updated = ? WHERE key = ? AND state = 'claimed' AND worker = ?",
+                (state, error, time.time(), key, worker)).rowcount == 1
+        return self.transaction(update)
+
+    def fail(self, worker, key, error, retry=True):
+        """
+        Report a failed item. With `retry` it goes back to pending (for
+        another worker) until it was claimed `max_attempts` times.
+        """
+        def update():
+            return self.conn.execute(
+                "UPDATE items SET state = CASE WHEN ? AND attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "error = ?, worker = NULL, lease_until = NULL, updated = ? "
+                "WHERE key = ? AND state = 'claimed' AND worker = ?",
+                (retry, self.max_attempts, error, time.time(), key, worker)).rowcount == 1
+        return self.transaction(update)
+
+    def release(self, worker):
+        """Give the claimed items of a stopping worker back (not counted as attempts)"""
+        def update():
+            return self.conn.execute(
+                "UPDATE items SET state = 'pending', worker = NULL, lease_until = NULL, "
+                "attempts = attempts - 1, updated = ? WHERE state = 'claimed' AND worker = ?",
+                (time.time(), worker)).rowcount
+        return self.transaction(update)
+
+    def counts(self):
+        """Number of items per state"""
+        with self.lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall()
+        return {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 0} | dict(rows)
+
+    def finished(self):
+        """True once no item is pending or claimed"""
+        counts = self.counts()
+        return not counts[PENDING] and not counts[CLAIMED]
+
+    def filenames(self):
+        """{key: filename} of all items"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT key, filename FROM items"))
+
+    def failed(self):
+        """(key, error) of the failed items"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT key, error FROM items WHERE state = 'failed' ORDER BY seq").fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class Heartbeat:
+    def __init__(self, queue, worker, interval=None):
+        """
+        Extend the leases of `worker` in the background (every third of
+        the lease by default) while used as a context manager.
+        """
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval or queue.lease / 3
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.worker)
+            except sqlite3.OperationalError:
+                # queue busy for longer than the timeout, next beat
+                pass
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()